@@ -0,0 +1,378 @@
+"""Wilma probe overhead benchmarks.
+
+Usage:
+
+    python benchmarks/bench.py [-o results.json] [-r REPEAT] [-k FILTER]
+
+The results are written as JSON, with one entry per benchmark. All timings are
+in nanoseconds. Micro-benchmarks report the time per call, measured over as
+many loops as fit in about 0.2 seconds, for every repeat. One-off operations,
+like injecting probes or reloading the configuration, report the time of every
+repeat. The garbage collector is disabled while measuring, and the minimum and
+the median are the most stable figures to compare between releases.
+
+The capture benchmarks block on the capture writer when its queue is full, and
+report the number of captures that were dropped, which must be zero.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import typing as t
+from importlib import import_module
+from importlib import invalidate_caches
+from pathlib import Path
+from subprocess import DEVNULL
+from subprocess import run
+from time import perf_counter_ns
+from timeit import Timer
+
+
+REPEAT = 7
+
+# Captures are truncated to MAXSIZE items per collection and to MAXOBJECTS
+# objects in total, so the largest size measures the cost of truncation.
+CAPTURE_SIZES = (1, 10, 100, 1000)
+INJECT_SIZES = ((1, 10), (10, 10), (10, 100))  # (modules, probes per module)
+RELOAD_SIZES = (10, 100, 1000)
+
+# Set up a private Wilma environment before importing anything from Wilma.
+WORKDIR = Path(tempfile.mkdtemp(prefix="wilma-bench-"))
+os.environ["WILMAPREFIX"] = str(WORKDIR / ".wilma")
+os.environ["WILMAFILE"] = str(WORKDIR / "wilma.toml")
+(WORKDIR / ".wilma").mkdir()
+sys.path.insert(0, str(WORKDIR))
+
+from wilma._capture import _writers  # noqa
+from wilma._config import wilmaenv  # noqa
+from wilma._inject import FunctionProbe  # noqa
+from wilma._inject import Probe  # noqa
+from wilma._inject import WilmaModuleWatchdog  # noqa
+from wilma._inject import code_cache  # noqa
+from wilma._inject import eject_probes  # noqa
+from wilma._inject import inject_probes  # noqa
+from wilma._inject import on_config_changed  # noqa
+
+
+TARGET = """\
+def target(x):
+    y = x + 1
+    return y
+
+
+def capture_target(data):
+    y = data
+    return y
+"""
+
+# The line of the body of the target function, where line probes are injected.
+TARGET_LINE = 2
+CAPTURE_LINE = 7
+
+
+def stats(times: t.List[float], **extra: t.Any) -> t.Dict[str, t.Any]:
+    return dict(
+        unit="ns",
+        runs=len(times),
+        min=min(times),
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        stdev=statistics.stdev(times) if len(times) > 1 else 0.0,
+        **extra,
+    )
+
+
+def timeit(f: t.Callable[[], t.Any], repeat: int) -> t.Dict[str, t.Any]:
+    """Time a single call of the given function."""
+    timer = Timer(f)
+    loops, _ = timer.autorange()
+    loops = max(loops, 1)
+    times = [_ * 1e9 / loops for _ in timer.repeat(repeat, loops)]
+    return stats(times, loops=loops)
+
+
+def time_once(
+    f: t.Callable[[], t.Any],
+    repeat: int,
+    setup: t.Optional[t.Callable[[], t.Any]] = None,
+    teardown: t.Optional[t.Callable[[], t.Any]] = None,
+) -> t.Dict[str, t.Any]:
+    """Time one-off operations, with the garbage collector disabled."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = perf_counter_ns()
+            f()
+            times.append(float(perf_counter_ns() - start))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if teardown is not None:
+            teardown()
+    return stats(times)
+
+
+_modules = 0
+
+
+def make_module(source: str = TARGET):
+    """Write and import a new module with the given source."""
+    global _modules
+
+    name = "wilma_bench_%d" % _modules
+    _modules += 1
+
+    (WORKDIR / f"{name}.py").write_text(source)
+    invalidate_caches()
+    return import_module(name)
+
+
+def make_functions_module(n: int):
+    return make_module(
+        "\n\n".join(f"def f{i}(x):\n    y = x + 1\n    return y\n" for i in range(n))
+    )
+
+
+def functions_lines(n: int) -> t.List[int]:
+    # Every function takes 5 lines, and its body starts on the second one.
+    return [5 * i + 2 for i in range(n)]
+
+
+def bench_calls(repeat: int) -> t.Iterator[t.Tuple[str, t.Dict[str, t.Any]]]:
+    module = make_module()
+    target = module.target
+
+    baseline = timeit(lambda: target(1), repeat)
+    yield "call.baseline", baseline
+
+    def overhead(result: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+        result["overhead"] = result["median"] - baseline["median"]
+        return result
+
+    # Line probes with different statements. The difference with the baseline
+    # is the cost of calling into the probe and executing its statement.
+    for name, statement, settings in (
+        ("pass", "pass", {}),
+        ("assign", "z = x * 2", {}),
+        ("when_false", "pass", {"when": "False"}),
+        ("sample_100", "pass", {"sample": 100}),
+    ):
+        probe = Probe(module.__file__, TARGET_LINE, statement, **settings)
+        inject_probes(module, [probe])
+        try:
+            yield f"call.line_probe[{name}]", overhead(
+                timeit(lambda: target(1), repeat)
+            )
+        finally:
+            eject_probes(module, [probe])
+
+    # Function probes, which wrap the whole function.
+    for name, hooks in (
+        ("entry", {"entry": "pass"}),
+        ("return", {"exit": "pass"}),
+    ):
+        function_probe = FunctionProbe(module.__name__, "target", **hooks)
+        function_probe.inject(module)
+        try:
+            yield (
+                f"call.function_probe[{name}]",
+                overhead(timeit(lambda: module.target(1), repeat)),
+            )
+        finally:
+            function_probe.eject()
+
+
+def bench_capture(repeat: int) -> t.Iterator[t.Tuple[str, t.Dict[str, t.Any]]]:
+    module = make_module()
+    target = module.capture_target
+
+    # Captures that are dropped at the queue are much cheaper than the ones that
+    # are written, so the producers wait for the writer instead. The timings
+    # include the cost of writing the captures.
+    wilmaenv.wilmaconfig = {"captures": {"overflow": "block"}}
+    (writer,) = _writers()
+
+    probe = Probe(module.__file__, CAPTURE_LINE, "wilma.capture()")
+    inject_probes(module, [probe])
+    try:
+        for size in CAPTURE_SIZES:
+            data = {
+                "items": [
+                    {"id": i, "name": str(i), "tags": [i, -i]} for i in range(size)
+                ],
+                "index": {str(i): float(i) for i in range(size)},
+            }
+            dropped = writer.dropped
+            result = timeit(lambda: target(data), repeat)
+            result["dropped"] = writer.dropped - dropped
+            if result["dropped"]:
+                raise RuntimeError(
+                    "%d captures were dropped. The results are not reliable"
+                    % result["dropped"]
+                )
+            yield f"capture[{size}]", result
+    finally:
+        eject_probes(module, [probe])
+
+
+def clear_code_cache() -> None:
+    shutil.rmtree(code_cache.path, ignore_errors=True)
+
+
+def bench_inject(repeat: int) -> t.Iterator[t.Tuple[str, t.Dict[str, t.Any]]]:
+    for n_modules, n_probes in INJECT_SIZES:
+        modules = [make_functions_module(n_probes) for _ in range(n_modules)]
+        probes = {
+            module: [
+                Probe(module.__file__, line, "pass")
+                for line in functions_lines(n_probes)
+            ]
+            for module in modules
+        }
+
+        def inject() -> None:
+            for module, module_probes in probes.items():
+                inject_probes(module, module_probes)
+
+        def eject() -> None:
+            for module, module_probes in probes.items():
+                eject_probes(module, module_probes)
+
+        size = dict(modules=n_modules, probes=n_modules * n_probes)
+        yield f"inject[{n_modules}x{n_probes}]", dict(
+            time_once(inject, repeat, setup=clear_code_cache, teardown=eject), **size
+        )
+        # With the instrumented code objects in the code cache already
+        yield f"inject.cached[{n_modules}x{n_probes}]", dict(
+            time_once(inject, repeat, teardown=eject), **size
+        )
+        yield f"eject[{n_modules}x{n_probes}]", dict(
+            time_once(eject, repeat, setup=inject), **size
+        )
+
+
+def bench_reload(repeat: int) -> t.Iterator[t.Tuple[str, t.Dict[str, t.Any]]]:
+    for n_probes in RELOAD_SIZES:
+        module = make_functions_module(n_probes)
+        config = {
+            "probes": {
+                f"{module.__file__}:{line}": "pass"
+                for line in functions_lines(n_probes)
+            }
+        }
+        empty: t.Dict[str, t.Any] = {"probes": {}}
+
+        yield f"reload.add[{n_probes}]", time_once(
+            lambda: on_config_changed(config),
+            repeat,
+            teardown=lambda: on_config_changed(empty),
+        )
+        on_config_changed(config)
+        yield f"reload.unchanged[{n_probes}]", time_once(
+            lambda: on_config_changed(config), repeat
+        )
+        yield f"reload.remove[{n_probes}]", time_once(
+            lambda: on_config_changed(empty),
+            repeat,
+            setup=lambda: on_config_changed(config),
+        )
+
+
+def bench_startup(repeat: int) -> t.Iterator[t.Tuple[str, t.Dict[str, t.Any]]]:
+    env = dict(os.environ)
+    wilma = [sys.executable, "-m", "wilma", sys.executable, "-c", "pass"]
+    python = [sys.executable, "-c", "pass"]
+
+    def spawn(args: t.List[str]) -> None:
+        run(args, env=env, cwd=str(WORKDIR), stdout=DEVNULL, stderr=DEVNULL, check=True)
+
+    # The first run installs the Wilma dependencies.
+    spawn(wilma)
+
+    baseline = time_once(lambda: spawn(python), repeat)
+    yield "startup.baseline", baseline
+
+    result = time_once(lambda: spawn(wilma), repeat)
+    result["overhead"] = result["median"] - baseline["median"]
+    yield "startup.wilma", result
+
+
+BENCHMARKS = {
+    "call": bench_calls,
+    "capture": bench_capture,
+    "inject": bench_inject,
+    "reload": bench_reload,
+    "startup": bench_startup,
+}
+
+
+def metadata() -> t.Dict[str, t.Any]:
+    try:
+        from importlib.metadata import version
+
+        wilma_version = version("wilma")
+    except Exception:
+        wilma_version = "dev"
+
+    return dict(
+        wilma=wilma_version,
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        machine=platform.machine(),
+    )
+
+
+def main() -> None:
+    argp = argparse.ArgumentParser(description="Wilma probe overhead benchmarks")
+    argp.add_argument(
+        "-o", "--output", type=Path, help="The output file. Defaults to stdout"
+    )
+    argp.add_argument(
+        "-r", "--repeat", type=int, default=REPEAT, help="The number of repeats"
+    )
+    argp.add_argument(
+        "-k",
+        "--select",
+        action="append",
+        choices=list(BENCHMARKS),
+        help="Only run the given benchmark groups",
+    )
+    args = argp.parse_args()
+
+    WilmaModuleWatchdog.install()
+
+    results = []
+    try:
+        for group in args.select or BENCHMARKS:
+            for name, result in BENCHMARKS[group](args.repeat):
+                print(
+                    "%-32s %14.1f ns (median)" % (name, result["median"]),
+                    file=sys.stderr,
+                )
+                results.append(dict(name=name, **result))
+    finally:
+        WilmaModuleWatchdog.uninstall()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    report = json.dumps(
+        dict(meta=metadata(), repeat=args.repeat, benchmarks=results), indent=2
+    )
+    if args.output is not None:
+        args.output.write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
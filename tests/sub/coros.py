@@ -0,0 +1,21 @@
+import asyncio
+
+
+def count(n):
+    for i in range(n):
+        yield i
+    return n
+
+
+async def nap(seconds):
+    await asyncio.sleep(seconds)
+    return seconds
+
+
+async def fail():
+    await asyncio.sleep(0)
+    raise ValueError("no nap")
+
+
+async def ticks():
+    yield 1
@@ -0,0 +1,7 @@
+def step(n):
+    return n * 2
+
+
+def run():
+    for n in range(100):
+        step(n)
@@ -0,0 +1,12 @@
+import asyncio
+
+import sub.coros as c
+
+
+print(list(c.count(3)))
+print(asyncio.run(c.nap(0.1)))
+
+try:
+    asyncio.run(c.fail())
+except ValueError:
+    pass
@@ -0,0 +1,16 @@
+def tick(n):
+    return n
+
+
+def tock(n):
+    return n
+
+
+def tack(n):
+    return n
+
+
+for i in range(100):
+    tick(i)
+    tock(i)
+    tack(i)
@@ -0,0 +1,34 @@
+from time import perf_counter_ns
+
+from wilma._budget import THROTTLE
+from wilma._budget import OverheadBudget
+from wilma._budget import ProbeOverhead
+
+
+def test_budget_usage():
+    overhead = ProbeOverhead(OverheadBudget(us_per_s=2000))
+
+    # 10 ms spent in the probe over 0.2 s
+    overhead._wall = 10_000_000
+    overhead._start = now = 1_000_000_000
+    us_per_s, _ = overhead.usage(now + 200_000_000)
+
+    assert us_per_s == 50_000
+
+
+def test_budget_record_over_budget():
+    overhead = ProbeOverhead(OverheadBudget(us_per_s=2000, window=0.2))
+    overhead._start = perf_counter_ns() - 200_000_000
+
+    assert overhead.record(10_000_000, 0) == THROTTLE
+    assert overhead.sample == 2
+    assert overhead.last_usage[0] > 2000
+
+
+def test_budget_record_within_budget():
+    overhead = ProbeOverhead(OverheadBudget(us_per_s=2000, window=0.2))
+    overhead._start = perf_counter_ns() - 200_000_000
+
+    # 100 µs over about 0.2 s
+    assert overhead.record(100_000, 0) is None
+    assert overhead.sample == 1
@@ -0,0 +1,47 @@
+from wilma._codecache import CodeCache
+
+
+class Probe(object):
+    def __init__(self, location):
+        self.location = location
+
+
+def test_code_cache_single_entry(tmp_path):
+    cache = CodeCache(tmp_path / "codecache")
+
+    # Edits of the same code and changes of its probes replace the entry.
+    keys = []
+    for i, source in enumerate(["x = 1", "x = 2", "x = 2"]):
+        code = compile(source, "module.py", "exec")
+        key = cache.key(code, [Probe("module.py:%d" % i)])
+        cache.put(key, code, [])
+        keys.append((key, code))
+
+    assert len(list((tmp_path / "codecache").iterdir())) == 1
+
+    assert all(cache.get(key, []) is None for key, _ in keys[:-1])
+    key, code = keys[-1]
+    cached, used = cache.get(key, [])
+    assert cached.co_consts == code.co_consts
+    assert used == set()
+
+    # Other code objects have entries of their own.
+    other = compile("x = 1", "other.py", "exec")
+    cache.put(cache.key(other, []), other, [])
+    assert len(list((tmp_path / "codecache").iterdir())) == 2
+
+
+def test_code_cache_probe_location(tmp_path):
+    cache = CodeCache(tmp_path / "codecache")
+    code = compile("x = 1", "module.py", "exec")
+
+    # Probes are keyed by their location only, so editing what a probe does
+    # does not invalidate the instrumented code.
+    probe = Probe("module.py:1")
+    cache.put(cache.key(code, [probe]), code, [None, probe])
+
+    edited = Probe("module.py:1")
+    assert cache.key(code, [edited]) == cache.key(code, [probe])
+    assert cache.get(cache.key(code, [edited]), [None, edited]) is not None
+
+    assert cache.key(code, [Probe("module.py:2")]) != cache.key(code, [probe])
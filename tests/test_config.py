@@ -1,4 +1,6 @@
 import os
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
@@ -40,3 +42,16 @@ def test_load(monkeypatch, tmp_path):
     monkeypatch.setenv("WILMAFILE", str(wilmafile))
 
     assert WilmaConfig().wilmaconfig == {"imports": []}
+
+
+def test_preload_other_module(tmp_path):
+    # A preload module of the application is not mistaken for ours.
+    (tmp_path / "preload.py").write_text("")
+
+    result = subprocess.check_output(
+        [sys.executable, "-c", "import preload, wilma; print(wilma.PRELOAD)"],
+        env=dict(os.environ, PYTHONPATH=str(tmp_path)),
+        cwd=str(tmp_path),
+    )
+
+    assert result.strip() == b"False"
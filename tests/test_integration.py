@@ -1,10 +1,14 @@
+import json
+import os
 import shutil
 import sys
 from pathlib import Path
 from subprocess import PIPE
+from subprocess import STDOUT
 from subprocess import check_output as _check_output
 from threading import Thread
 from time import sleep
+from zipfile import ZipFile
 
 import pytest
 
@@ -44,6 +48,83 @@ imported class secret="I'm an imported class secret!"
     ), result
 
 
+def test_bootstrap_cache(tmp_path):
+    env = dict(os.environ, WILMACACHE=str(tmp_path))
+    for _ in range(2):
+        assert (
+            check_output(
+                [EXE, sys.executable, "-c", "print('Wilma rox!')"],
+                stderr=PIPE,
+                cwd=str(HERE),
+                env=env,
+            )
+            == "Wilma rox!\n"
+        )
+
+    # The dependencies are installed once, in the shared cache.
+    (deps,) = (tmp_path / "bootstrap").iterdir()
+    assert not deps.name.startswith(".")
+    assert not (HERE / ".wilma" / "deps").exists()
+
+
+def test_profile_startup():
+    result = check_output([EXE, "--profile-startup"], stderr=PIPE, cwd=str(HERE))
+
+    lines = result.splitlines()
+    assert lines[2].startswith("wilma: preloading Wilma took ")
+    assert "preload" in {_.split("|")[-1].strip() for _ in lines[5:]}, result
+
+
+def test_lazy_startup(tmp_path):
+    def imports(wilmafile, *args):
+        result = _check_output(
+            [EXE, "-c", str(wilmafile), sys.executable, "-X", "importtime"]
+            + list(args),
+            stderr=STDOUT,
+            cwd=str(HERE),
+        )
+        return {
+            line.rpartition("|")[2].strip()
+            for line in result.decode().splitlines()
+            if line.startswith("import time:")
+        }
+
+    heavy = {"ddtrace", "bytecode"}
+
+    # Without probes, there is nothing to load or to watch.
+    missing = tmp_path / "missing.toml"
+    assert not (heavy | {"toml", "watchdog"}) & imports(missing, "-c", "pass")
+
+    # The Wilma file is watched, but the probes are only loaded when a module
+    # that might have probes is imported.
+    wilmafile = tmp_path / "lazy.toml"
+    wilmafile.write_text('[probes]\n"nowhere.py:1" = "print(42)"\n')
+    lazy = imports(wilmafile, "-c", "import json")
+    assert "watchdog" in lazy
+    assert not heavy & lazy
+
+    assert heavy <= imports(HERE / "wilma.toml", "-m", "target")
+
+
+def test_code_cache():
+    codecache = HERE / ".wilma" / "codecache"
+
+    def run_target():
+        output = check_output(
+            [EXE, sys.executable, "-m", "target"], stderr=PIPE, cwd=str(HERE)
+        )
+        return output, {_.name: _.stat().st_mtime_ns for _ in codecache.iterdir()}
+
+    outputs, entries = zip(*(run_target() for _ in range(2)))
+
+    # The second run loads the instrumented code from the cache, so no entries
+    # are added or rewritten.
+    assert entries[0]
+    assert entries[0] == entries[1]
+    assert outputs[0] == outputs[1]
+    assert 'imported secret="I\'m an imported secret!"' in outputs[1]
+
+
 def test_tools_locals():
     result = check_output(
         [
@@ -145,3 +226,459 @@ def test_wilmafile_watch(tmp_path):
     writer.join()
 
     assert "foo" in result and "bar" in result, result
+
+
+def test_wilmafile_watch_atomic_save(tmp_path):
+    wilmafile_content = (HERE / "watch.toml").read_text()
+    wilmafile = tmp_path / "watch.toml"
+    wilmafile.write_text(wilmafile_content)
+
+    def save():
+        sleep(1)
+        # Unrelated files in the same folder are ignored.
+        (tmp_path / "other.toml").write_text("garbage")
+        # Save like editors do, by renaming a temporary file over the original.
+        swap = tmp_path / ".watch.toml.swp"
+        swap.write_text(wilmafile_content.replace("foo", "bar"))
+        os.replace(str(swap), str(wilmafile))
+
+    writer = Thread(target=save)
+    writer.start()
+
+    result = check_output(
+        [
+            EXE,
+            "-c",
+            str(wilmafile),
+            sys.executable,
+            "-m",
+            "target_watch",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    writer.join()
+
+    assert "foo" in result and "bar" in result, result
+    assert "invalid configuration" not in result, result
+
+
+def make_wheel(path, name, version, source):
+    wheel = path / f"{name}-{version}-py3-none-any.whl"
+    dist_info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": source,
+        f"{dist_info}/METADATA": (
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n"
+        ),
+        f"{dist_info}/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: wilma\nRoot-Is-Purelib: true\n"
+            "Tag: py3-none-any\n"
+        ),
+    }
+    with ZipFile(wheel, "w") as z:
+        for filename, content in files.items():
+            z.writestr(filename, content)
+        z.writestr(
+            f"{dist_info}/RECORD",
+            "".join(f"{_},,\n" for _ in files) + f"{dist_info}/RECORD,,\n",
+        )
+    return wheel
+
+
+def test_dependencies_lock(tmp_path):
+    wheel = make_wheel(tmp_path, "wilmadep", "1.0", "SECRET = 'Wilma rox!'\n")
+    wilmafile = tmp_path / "deps.toml"
+    wilmafile.write_text(
+        (HERE / "deps.toml").read_text().replace("WHEEL", wheel.as_uri())
+    )
+
+    def run_target():
+        return check_output(
+            [EXE, "-c", str(wilmafile), sys.executable, "-m", "target_watch"],
+            stderr=PIPE,
+            cwd=str(HERE),
+        ).splitlines()
+
+    # The dependencies are installed in the background, while the target runs.
+    # The probes that need them are activated once they are available, the
+    # others right away.
+    lines = run_target()
+    assert lines[0] == "wilma: installing dependencies in the background"
+    assert "Wilma rox!" in lines
+    assert lines.index("tick") < lines.index("Wilma rox!")
+
+    lock = json.loads((HERE / ".wilma" / "deps.lock").read_text())
+    assert lock["resolved"] == {"wilmadep": "1.0"}
+
+    # The dependencies are locked, so the probes are active from the start.
+    assert run_target() == ["Wilma rox!", "default", "tick"] * 15
+
+
+def test_probe_invalid_syntax():
+    result = check_output(
+        [EXE, "-c", str(HERE / "invalid.toml"), sys.executable, "-m", "target"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    assert "wilma: invalid probe 'target.py:14'" in result, result
+    assert 'secret="Wilma rox!"' in result, result
+    assert "\nunbalanced\n" not in result, result
+
+
+def test_probe_scopes():
+    result = check_output(
+        [EXE, "-c", str(HERE / "scopes.toml"), sys.executable, "-m", "target"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    assert '["Wilma rox!"] [True]' in result, result
+    assert "\nI'm an imported secret!\n" in result, result
+    assert "relative True sub.importme True" in result, result
+
+
+def test_probe_limits():
+    result = check_output(
+        [EXE, "-c", str(HERE / "limits.toml"), sys.executable, "-m", "target_loop"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    lines = result.splitlines()
+    assert [_ for _ in lines if _.startswith("tick")] == [
+        "tick %d" % n for n in range(0, 100, 10)
+    ]
+    assert [_ for _ in lines if _.startswith("tock")] == ["tock 0", "tock 1", "tock 2"]
+    assert [_ for _ in lines if _.startswith("tack")] == ["tack 0"]
+
+
+def test_probe_when():
+    result = check_output(
+        [EXE, "-c", str(HERE / "when.toml"), sys.executable, "-m", "target_loop"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    lines = result.splitlines()
+    assert [_ for _ in lines if _.startswith(("tick", "tock", "tack"))] == [
+        "tick 0",
+        "tick 25",
+        "tick 50",
+        "tick 75",
+        "tock 98",
+    ]
+    assert any(
+        _.startswith("wilma: invalid probe 'target_loop.py:10'") for _ in lines
+    ), result
+
+
+def test_probe_functions_when():
+    result = check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "when_functions.toml"),
+            sys.executable,
+            "-c",
+            "from sub.loop import run; run()",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    # Only the calls that match the condition count towards the limits, like
+    # with line probes.
+    assert result.splitlines() == [
+        _ for n in range(0, 100, 20) for _ in (f"step {n}", f"stepped {2 * n}")
+    ]
+
+
+def test_probe_overhead_budget():
+    result = check_output(
+        [EXE, "-c", str(HERE / "budget.toml"), sys.executable, "-m", "target_loop"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    # The probe goes over budget at the end of the first window, and it does
+    # not fire again after it is ejected.
+    lines = result.splitlines()
+    (ejected,) = [i for i, _ in enumerate(lines) if _.endswith("Ejecting probe.")]
+    assert "over its overhead budget" in lines[ejected], result
+    assert any(_.startswith("tick") for _ in lines[:ejected]), result
+    assert not any(_.startswith("tick") for _ in lines[ejected:]), result
+
+
+def test_probe_functions():
+    result = check_output(
+        [EXE, "-c", str(HERE / "functions.toml"), sys.executable, "-m", "target"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    lines = result.splitlines()
+    assert "wilma: function 'sub.importme:nope' not found. Skipping probe." in lines
+    assert lines[lines.index("entering foo") + 1] == (
+        "I'm not telling you the imported secret!"
+    )
+    assert lines[-1] == "bar returned None True"
+
+    (snapshot,) = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+    assert snapshot["probe"] == "sub.importme:Foo.bar"
+    assert snapshot["stack"][0]["function"] == "bar"
+    assert list(snapshot["locals"]) == ["self"]
+
+
+def test_probe_functions_coroutines():
+    result = check_output(
+        [EXE, "-c", str(HERE / "coros.toml"), sys.executable, "-m", "target_coros"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    assert result.splitlines() == [
+        "wilma: cannot probe function 'sub.coros:ticks': async generator functions "
+        "are not supported. Skipping probe.",
+        "count returned 3 True",
+        "[0, 1, 2]",
+        "nap returned 0.1 True",
+        "0.1",
+        "fail raised ValueError('no nap')",
+    ]
+
+    (snapshot,) = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+    assert snapshot["probe"] == "sub.coros:nap"
+    assert snapshot["stack"][0]["function"] == "nap"
+    assert list(snapshot["locals"]) == ["seconds"]
+
+
+def test_probe_patterns():
+    result = check_output(
+        [EXE, "-c", str(HERE / "patterns.toml"), sys.executable, "-m", "target"],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    assert result.splitlines()[2:] == [
+        "entering []",
+        "I'm not telling you the imported secret!",
+        "line 6",
+        "entering ['self']",
+        "I'm not telling you the imported class secret!",
+        "returned None",
+    ]
+
+
+def test_tools_capture():
+    check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "tools" / "capture.toml"),
+            sys.executable,
+            "-m",
+            "target",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    (snapshot,) = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+
+    assert snapshot["type"] == "snapshot"
+    assert snapshot["stack"][0]["function"] == "foo"
+
+    objects = {_["id"]: _ for _ in snapshot["objects"]}
+    assert objects[snapshot["locals"]["secret"]]["value"] == "'Wilma rox!'"
+
+
+def test_tools_capture_binary():
+    for _ in range(2):
+        check_output(
+            [
+                EXE,
+                "-c",
+                str(HERE / "tools" / "capture_binary.toml"),
+                sys.executable,
+                "-m",
+                "target",
+            ],
+            stderr=PIPE,
+            cwd=str(HERE),
+        )
+
+    assert not (HERE / ".wilma" / "captures.log").exists()
+
+    result = check_output([EXE, "decode"], stderr=PIPE, cwd=str(HERE))
+
+    snapshots = [json.loads(_) for _ in result.splitlines()]
+    assert [_["stack"][0]["function"] for _ in snapshots] == ["foo", "bar"] * 2
+
+    objects = {_["id"]: _ for _ in snapshots[0]["objects"]}
+    assert objects[snapshots[0]["locals"]["secret"]]["value"] == "'Wilma rox!'"
+
+
+def test_tools_capture_ring():
+    for _ in range(2):
+        check_output(
+            [
+                EXE,
+                "-c",
+                str(HERE / "tools" / "capture_ring.toml"),
+                sys.executable,
+                "-m",
+                "target",
+            ],
+            stderr=PIPE,
+            cwd=str(HERE),
+        )
+
+    ring = HERE / ".wilma" / "captures.ring"
+    assert ring.stat().st_size > 1 << 20
+
+    result = check_output([EXE, "decode", str(ring)], stderr=PIPE, cwd=str(HERE))
+
+    snapshots = [json.loads(_) for _ in result.splitlines()]
+    assert [_["stack"][0]["function"] for _ in snapshots] == ["foo", "bar"] * 2
+
+
+def test_tools_capture_shallow():
+    check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "tools" / "capture_shallow.toml"),
+            sys.executable,
+            "-m",
+            "target",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    (snapshot,) = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+
+    assert snapshot["stack"][0]["function"] == "foo"
+
+    objects = {_["id"]: _ for _ in snapshot["objects"]}
+    assert objects[snapshot["locals"]["secret"]]["value"] == "'Wilma rox!'"
+
+    # The list is captured as it was when the snapshot was taken
+    items = objects[snapshot["locals"]["items"]]
+    assert items["size"] == 2
+    assert [objects[_]["value"] for _ in items["elements"]] == ["1", "2"]
+
+
+def test_tools_capture_delta():
+    check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "tools" / "capture_delta.toml"),
+            sys.executable,
+            "-m",
+            "target",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    first, second = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+
+    # The unchanged objects are only written once
+    assert first["objects"][0]["value"] == "'Wilma rox!'"
+    assert second["objects"] == [{"ref": first["objects"][0]["id"]}]
+
+    result = check_output([EXE, "decode"], stderr=PIPE, cwd=str(HERE))
+
+    snapshots = [json.loads(_) for _ in result.splitlines()]
+    assert [_["objects"] for _ in snapshots] == [first["objects"]] * 2
+    assert {_["probe"] for _ in snapshots} == {str(HERE / "target.py") + ":6"}
+
+
+def test_tools_capture_stacks():
+    check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "tools" / "capture_stacks.toml"),
+            sys.executable,
+            "-m",
+            "target",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    records = [
+        json.loads(_)
+        for _ in (HERE / ".wilma" / "captures.log").read_text().splitlines()
+    ]
+
+    # Every distinct stack is written once, before the first snapshot that
+    # refers to it.
+    assert [_["type"] for _ in records] == [
+        "stack",
+        "snapshot",
+        "snapshot",
+        "stack",
+        "snapshot",
+    ]
+    assert [_["stackId"] for _ in records if _["type"] == "snapshot"] == [0, 0, 1]
+    assert records[0]["frames"][0]["function"] == "foo"
+
+    result = check_output([EXE, "decode"], stderr=PIPE, cwd=str(HERE))
+
+    snapshots = [json.loads(_) for _ in result.splitlines()]
+    assert [_["stack"][0]["function"] for _ in snapshots] == ["foo", "foo", "bar"]
+    assert not any("stackId" in _ for _ in snapshots)
+
+
+def test_tools_metrics():
+    check_output(
+        [
+            EXE,
+            "-c",
+            str(HERE / "tools" / "metrics.toml"),
+            sys.executable,
+            "-m",
+            "target_loop",
+        ],
+        stderr=PIPE,
+        cwd=str(HERE),
+    )
+
+    records = {
+        (_["type"], _["name"]): _
+        for _ in map(
+            json.loads, (HERE / ".wilma" / "metrics.log").read_text().splitlines()
+        )
+    }
+
+    assert records["counter", "tick"]["count"] == 100
+
+    n = records["histogram", "n"]
+    assert (n["count"], n["sum"], n["min"], n["max"]) == (100, 4950, 0, 99)
+    assert abs(n["p50"] - 49.5) < 1
+
+    timer = records["histogram", "tick"]
+    assert timer["count"] == 100
+    assert 0 < timer["min"] <= timer["p50"] <= timer["max"]
@@ -0,0 +1,37 @@
+from wilma._locations import ProbeLocations
+
+
+def test_probe_locations():
+    locations = ProbeLocations(
+        {
+            "probes": {
+                "app/views.py:42": "pass",
+                "app/models/__init__.py:1": "pass",
+                "app.handlers:handle": "pass",
+                "app.tasks.*:run": "pass",
+                "/app/jobs/*.py:1": "pass",
+            }
+        }
+    )
+    paths = []
+
+    def path(value):
+        return lambda: paths.append(value) or value
+
+    assert locations.matches("app.views", path(None))
+    assert locations.matches("other.views", path(None))
+    assert locations.matches("app.models", path(None))
+    assert locations.matches("app.handlers", path(None))
+    assert locations.matches("app.tasks.email", path(None))
+    assert not paths
+
+    # The paths of the modules are only looked up for the file patterns.
+    assert locations.matches("jobs.nightly", path("/app/jobs/nightly.py"))
+    assert not locations.matches("app.urls", path("/app/urls.py"))
+    assert paths == ["/app/jobs/nightly.py", "/app/urls.py"]
+
+
+def test_probe_locations_empty():
+    assert not ProbeLocations({})
+    assert not ProbeLocations({"imports": ["json"]})
+    assert not ProbeLocations({"probes": {"app:/(/": "pass"}})
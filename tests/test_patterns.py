@@ -0,0 +1,47 @@
+import os
+
+from wilma._patterns import PatternProbe
+
+
+def test_pattern_files():
+    probe = PatternProbe("/app/handlers/*.py:*", "pass")
+
+    assert probe.matches("app.handlers.main", "/app/handlers/main.py")
+    assert not probe.matches("app.handlers.sub.deep", "/app/handlers/sub/deep.py")
+
+
+def test_pattern_files_recursive():
+    probe = PatternProbe("/app/**/views.py:42", "pass")
+
+    assert probe.matches("app.views", "/app/views.py")
+    assert probe.matches("app.a.b.views", "/app/a/b/views.py")
+    assert not probe.matches("app.a.models", "/app/a/models.py")
+
+
+def test_pattern_files_relative(tmp_path):
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        probe = PatternProbe("sub/import?e.py:6", "pass")
+    finally:
+        os.chdir(cwd)
+
+    assert probe.matches("sub.importme", str(tmp_path / "sub" / "importme.py"))
+    assert not probe.matches("sub.import.e", str(tmp_path / "sub" / "import/e.py"))
+
+
+def test_pattern_modules():
+    probe = PatternProbe("sub.import*:*", "pass")
+
+    assert probe.matches("sub.importme", None)
+    assert not probe.matches("sub.importme.inner.x", None)
+    assert PatternProbe("sub.**:*", "pass").matches("sub.importme.inner.x", None)
+
+
+def test_pattern_functions():
+    qualnames = ["foo", "Foo.bar", "Foo.Baz.qux", "bar"]
+
+    assert PatternProbe("m:*", "pass").functions(qualnames) == ["foo", "bar"]
+    assert PatternProbe("m:Foo.*", "pass").functions(qualnames) == ["Foo.bar"]
+    assert PatternProbe("m:**", "pass").functions(qualnames) == qualnames
+    assert PatternProbe("m:[!F]*", "pass").functions(qualnames) == ["foo", "bar"]
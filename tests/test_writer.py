@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+import threading
+from time import sleep
+
+import pytest
+
+from wilma._capture import DeferredCaptureContext
+from wilma._capture import _file_writer
+from wilma._codec import decode
+from wilma._delta import DeltaDecoder
+from wilma._delta import DeltaEncoder
+from wilma._ring import RingBuffer
+from wilma._ring import records
+from wilma._writer import WRITERS
+from wilma._writer import AsyncWriter
+from wilma._writer import BinaryFileWriter
+from wilma._writer import JsonFileWriter
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_binary_writer_fork(tmp_path):
+    path = tmp_path / "captures.bin"
+    writer = BinaryFileWriter(path)
+    writer.write([{"parentkey": 1}])
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            writer.after_fork()
+            writer.write([{"childkey": 2}])
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    # A new string after the fork
+    writer.write([{"otherkey": 3}])
+    writer.close()
+
+    with path.open("rb") as stream:
+        assert list(decode(stream)) == [
+            {"parentkey": 1},
+            {"childkey": 2},
+            {"otherkey": 3},
+        ]
+
+
+def test_delta_encoder_pid():
+    encoder = DeltaEncoder()
+    decoder = DeltaDecoder()
+
+    def snapshot(pid):
+        return {
+            "type": "snapshot",
+            "probe": "target.py:6",
+            "pid": pid,
+            "objects": [{"id": 1, "type": "str", "value": "Wilma rox!"}],
+        }
+
+    # A forked child must write the objects that its parent wrote in full.
+    parent = encoder.encode(snapshot(1))
+    child = encoder.encode(snapshot(2))
+
+    assert decoder.decode(parent) == snapshot(1)
+    assert decoder.decode(child) == snapshot(2)
+
+
+def test_delta_encoder_shallow():
+    encoder = DeltaEncoder()
+    items = ["Wilma", "rox!"]
+
+    def snapshot():
+        # The shallow snapshot takes a copy of the list on every hit.
+        context = DeferredCaptureContext(sys._getframe(1), probe="test:1")
+        return encoder.encode(context.to_json())
+
+    first, second = snapshot(), snapshot()
+
+    # The copies are reported as the original list, so the second snapshot
+    # refers back to the first one.
+    assert first["locals"]["items"] == second["locals"]["items"] == id(items)
+    assert id(items) in {_["id"] for _ in first["objects"]}
+    assert {"ref": id(items)} in second["objects"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_ring_fork(tmp_path):
+    path = tmp_path / "captures.ring"
+    ring = RingBuffer(path, 1 << 20)
+
+    # Parent and child write to the same ring at the same time, and neither
+    # overwrites the records of the other.
+    pid = os.fork()
+    name = b"child" if pid == 0 else b"parent"
+    try:
+        for i in range(5000):
+            ring.write(b"%s %d" % (name, i))
+    finally:
+        if pid == 0:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    ring.close()
+
+    found = list(records(path.read_bytes()))
+    assert len(found) == len(set(found)) == 10000
+
+
+class SlowCapture(object):
+    def to_json(self):
+        sleep(1.5)
+        return {"slow": True}
+
+
+def test_async_writer_close_busy(tmp_path):
+    threads = set()
+
+    class Writer(JsonFileWriter):
+        def write(self, captures):
+            threads.add(threading.current_thread())
+            super().write(captures)
+
+    path = tmp_path / "captures.log"
+    writer = AsyncWriter(Writer(path), batch_size=1, flush_interval=0.01)
+    writer(SlowCapture())
+    sleep(0.1)
+    writer({"fast": True})
+
+    # The writer thread outlives the close timeout, and it is left to write
+    # the pending captures on its own.
+    writer.close()
+    writer._thread.join()
+
+    assert threads == {writer._thread}
+    assert [json.loads(_) for _ in path.read_text().splitlines()] == [
+        {"slow": True},
+        {"fast": True},
+    ]
+    assert writer.writer.stream is None
+
+
+def test_async_writer_close_busy_exiting(tmp_path):
+    path = tmp_path / "captures.log"
+    writer = AsyncWriter(JsonFileWriter(path), batch_size=1, flush_interval=0.01)
+    writer(SlowCapture())
+    sleep(0.1)
+    writer({"fast": True})
+
+    # The writer thread would not survive the exit, so closing waits for it to
+    # write the pending captures.
+    writer.close(exiting=True)
+
+    assert not writer._thread.is_alive()
+    assert [json.loads(_) for _ in path.read_text().splitlines()] == [
+        {"slow": True},
+        {"fast": True},
+    ]
+    assert writer.writer.stream is None
+
+
+def test_file_writer_formats(monkeypatch):
+    assert isinstance(_file_writer({"format": "binary"}), BinaryFileWriter)
+    assert isinstance(_file_writer({}), JsonFileWriter)
+
+    # Every registered writer is a valid format.
+    class CsvFileWriter(JsonFileWriter):
+        pass
+
+    monkeypatch.setitem(WRITERS, "csv", CsvFileWriter)
+    writer = _file_writer({"format": "csv"})
+    assert isinstance(writer, CsvFileWriter)
+    assert writer.path.name == "captures.csv"
+
+    with pytest.raises(ValueError):
+        _file_writer({"format": "yaml"})
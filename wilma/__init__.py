@@ -1,33 +1,68 @@
+import os
 import sys
-from pathlib import Path
 
-import pkg_resources
 
+def _preloading() -> bool:
+    # The preload module is imported as a top-level module from our bootstrap
+    # folder, so we check where it comes from, as the application might have
+    # a preload module of its own.
+    preload = sys.modules.get("preload")
+    filename = getattr(preload, "__file__", None)
+    if filename is None:
+        return False
 
-# Determine if we are preloading Wilma. We expect dependencies to be available
-# in this case.
-PRELOAD = False
+    def folder(path: str) -> str:
+        return os.path.normcase(os.path.dirname(os.path.abspath(path)))
 
-frame = sys._getframe()
-while frame:
-    if Path(frame.f_code.co_filename).name == "preload.py":
-        PRELOAD = True
-        break
-    frame = frame.f_back
+    return folder(filename) == os.path.join(folder(__file__), "_bootstrap")
 
-try:
-    from wilma._tools import capture
-    from wilma._tools import framestack
-    from wilma._tools import locals
-    from wilma._tools import watch
 
-    __all__ = ["framestack", "locals", "capture", "watch"]
+# Determine if we are preloading Wilma.
+PRELOAD = _preloading()
 
-except ImportError as e:
-    if PRELOAD:
-        raise
+__all__ = [
+    "framestack",
+    "locals",
+    "capture",
+    "watch",
+    "count",
+    "histogram",
+    "start",
+    "stop",
+]
 
-try:
-    __version__ = pkg_resources.get_distribution(__name__).version
-except pkg_resources.DistributionNotFound:
-    __version__ = "dev"
+
+def _version() -> str:
+    try:
+        from importlib.metadata import PackageNotFoundError
+        from importlib.metadata import version
+    except ImportError:
+        # Python < 3.8
+        return "dev"
+
+    try:
+        return version(__name__)
+    except PackageNotFoundError:
+        return "dev"
+
+
+def __getattr__(name):
+    # Import the tools only when they are needed, e.g. not when running the
+    # wilma command. When preloading, the dependencies are only available while
+    # the probes are loaded, so that is when the tools are imported, and we
+    # find them among the submodules.
+    if name in __all__:
+        tools = globals().get("_tools")
+        if tools is None:
+            from wilma import _tools as tools
+
+        # Make the tools plain attributes, for faster lookups from the probes.
+        value = globals()[name] = getattr(tools, name)
+        return value
+
+    # Looking up the version is slow, and it is seldom needed.
+    if name == "__version__":
+        value = globals()[name] = _version()
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
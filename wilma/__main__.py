@@ -1,13 +1,120 @@
 import argparse
+import json
 import os
 import sys
 
 from wilma import __version__
 
 
+def decode(argv):
+    parser = argparse.ArgumentParser(
+        description="Decode a Wilma captures file to JSON lines. Snapshots are "
+        "recovered from ring files too, even if the process that wrote them died.",
+        prog="wilma decode",
+    )
+    parser.add_argument(
+        "file",
+        nargs="?",
+        help="The captures file to decode. Defaults to the first of the binary, "
+        "ring and JSON captures files found in the Wilma prefix directory",
+        type=str,
+    )
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        help="The Wilma prefix directory",
+        type=str,
+        default=os.getenv("WILMAPREFIX", ".wilma"),
+    )
+    args = parser.parse_args(argv)
+
+    from wilma._codec import DecodeError
+    from wilma._codec import decode as decode_captures
+
+    path = args.file
+    if path is None:
+        for name in ("captures.bin", "captures.ring", "captures.log"):
+            path = os.path.join(args.prefix, name)
+            if os.path.exists(path):
+                break
+    try:
+        with open(path, "rb") as stream:
+            for capture in decode_captures(stream):
+                print(json.dumps(capture))
+    except OSError as e:
+        print("wilma: cannot read captures file '%s': %s" % (path, e))
+        sys.exit(1)
+    except DecodeError as e:
+        print("wilma: captures file '%s' is corrupted: %s" % (path, e))
+        sys.exit(1)
+    except BrokenPipeError:
+        sys.stderr.close()
+
+    sys.exit(0)
+
+
+SUBCOMMANDS = {"decode": decode}
+
+# The number of imports to report when profiling the startup
+PROFILE_TOP = 20
+
+
+def profile_startup(command, env):
+    """Run the command and report the time taken by the imports at startup.
+
+    The import times are collected with ``python -X importtime``, and the
+    imports are reported by cumulative time, like the output of ``importtime``
+    itself.
+    """
+    import subprocess
+    from time import perf_counter
+
+    env = dict(env, PYTHONPROFILEIMPORTTIME="1")
+
+    start = perf_counter()
+    try:
+        result = subprocess.run(command, env=env, stderr=subprocess.PIPE)
+    except OSError as e:
+        print("wilma: cannot run '%s': %s" % (command[0], e))
+        sys.exit(1)
+    elapsed = perf_counter() - start
+
+    imports = []
+    for line in result.stderr.decode(errors="replace").splitlines():
+        prefix, _, timings = line.partition("import time:")
+        if prefix or not timings:
+            # Not an import time line
+            print(line, file=sys.stderr)
+            continue
+        try:
+            self_us, cumulative_us, name = timings.split("|")
+            imports.append((int(cumulative_us), int(self_us), name.rstrip()))
+        except ValueError:
+            # The header line
+            continue
+
+    wilma_us = sum(c for c, _, name in imports if name.strip() == "sitecustomize")
+    total_us = sum(c for c, _, name in imports if not name.startswith("  "))
+
+    print(f"wilma: process ran in {elapsed * 1e3:.1f} ms")
+    print(f"wilma: {len(imports)} imports took {total_us / 1e3:.1f} ms")
+    print(f"wilma: preloading Wilma took {wilma_us / 1e3:.1f} ms")
+    print()
+    print(f"{'cumulative [us]':>16} | {'self [us]':>10} | module")
+    imports.sort(reverse=True)
+    for cumulative_us, self_us, name in imports[:PROFILE_TOP]:
+        print(f"{cumulative_us:>16} | {self_us:>10} | {name}")
+
+    sys.exit(result.returncode)
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         # description="",
+        epilog="Run 'wilma decode -h' for help on decoding captures files.",
         prog="wilma",
     )
     parser.add_argument(
@@ -31,6 +138,12 @@ def main():
         action="store_true",
         help="Enable verbose logging",
     )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the time taken by the imports at startup. Defaults to "
+        "profiling an empty Python script if no command is given",
+    )
     parser.add_argument(
         "-V",
         "--version",
@@ -43,6 +156,9 @@ def main():
 
     bootstrap_dir = os.path.join(root_dir, "_bootstrap")
 
+    if args.profile_startup and not args.command:
+        args.command = [sys.executable, "-c", "pass"]
+
     if not args.command:
         parser.print_help()
         sys.exit(1)
@@ -63,6 +179,9 @@ def main():
         else bootstrap_dir
     )
 
+    if args.profile_startup:
+        profile_startup(args.command, env)
+
     try:
         os.execvpe(executable, args.command, env)  # TODO: Cross-platform?
     except (OSError, PermissionError):
@@ -1,63 +1,151 @@
 import atexit
+import hashlib
 import logging
 import os
+import shutil
 import site
 import sys
+import sysconfig
+import tempfile
+import threading
+import typing as t
 from contextlib import contextmanager
+from importlib.util import find_spec
 from pathlib import Path
 from subprocess import check_output
+from types import ModuleType
 
 
 LOGGER = logging.getLogger(__name__)
 
 WILMAPREFIX = Path(os.getenv("WILMAPREFIX", ".wilma"))
+# Dependencies installed by earlier versions of Wilma, within the prefix
 DEPS = WILMAPREFIX / "deps"
-if not DEPS.exists():
-    # Install Wilma dependencies in isolation
-    dependencies = [
-        "ddtrace~=1.9",
-        "toml~=0.10.2",
-        "envier~=0.4",
-        "bytecode~=0.13.0; python_version<'3.8'",
-        "bytecode~=0.14.0; python_version>='3.8'",
-        "watchdog~=2.1.9",
-    ]
+
+DEPENDENCIES = [
+    "ddtrace~=1.9",
+    "toml~=0.10.2",
+    "envier~=0.4",
+    "bytecode~=0.13.0; python_version<'3.8'",
+    "bytecode~=0.14.0; python_version>='3.8'",
+    "watchdog~=2.1.9",
+]
+
+
+def cache_dir() -> Path:
+    """The user-level cache directory of Wilma."""
+    cache = os.getenv("WILMACACHE")
+    if cache:
+        return Path(cache)
+
+    if sys.platform == "win32":
+        local = os.getenv("LOCALAPPDATA")
+        return (Path(local) if local else Path.home() / "AppData" / "Local") / "wilma"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "wilma"
+
+    xdg_cache = os.getenv("XDG_CACHE_HOME")
+    return (Path(xdg_cache) if xdg_cache else Path.home() / ".cache") / "wilma"
+
+
+def bootstrap_key() -> str:
+    # Installed dependencies can be shared by all the interpreters with the
+    # same version and ABI, as long as the dependencies are the same.
+    digest = hashlib.sha256()
+    for part in [
+        sys.implementation.cache_tag or sys.implementation.name,
+        sysconfig.get_config_var("SOABI") or "",
+        sysconfig.get_platform(),
+        "%d.%d" % sys.version_info[:2],
+    ] + DEPENDENCIES:
+        digest.update(part.encode() + b"\0")
+    return digest.hexdigest()[:16]
+
+
+def install(deps: Path) -> None:
+    """Install the Wilma dependencies in a new virtual environment.
+
+    The environment is created in a temporary directory first, and renamed
+    once the installation is complete, so that other processes never see a
+    partial installation. If a local wheelhouse is given with
+    ``WILMAWHEELHOUSE``, the dependencies are installed from it, without
+    reaching out to any package index.
+    """
+    deps.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{deps.name}-", dir=str(deps.parent)))
     try:
         env = dict(os.environ)
 
         # Create a virtual environment to completely isolate Wilma's
         # dependencies.
         env["PYTHONPATH"] = ""
-        check_output(
-            [sys.executable, "-m", "venv", str(DEPS.resolve())],
-            env=env,
-        )
-        check_output(
-            [
-                str(DEPS / "bin" / "python"),
-                "-m",
-                "pip",
-                "install",
-                "--prefix",
-                str(DEPS.resolve()),
-                "--no-input",
-                "--no-python-version-warning",
-            ]
-            + dependencies,
-            env=env,
-        )
-    except Exception:
-        LOGGER.error("Failed to install dependencies", exc_info=True)
-        raise
-
-# Add Wilma dependencies to the path
-wilma_deps = site.getsitepackages(prefixes=[str(DEPS.resolve())])
-sys.path[0:0] = wilma_deps
-
-import wilma._bootstrap.run_module  # noqa
-from wilma._config import wilmaenv
-from wilma._inject import WilmaModuleWatchdog
-from wilma._inject import on_config_changed
+        check_output([sys.executable, "-m", "venv", str(tmp)], env=env)
+
+        args = [
+            str(tmp / "bin" / "python"),
+            "-m",
+            "pip",
+            "install",
+            "--prefix",
+            str(tmp),
+            "--no-input",
+            "--no-python-version-warning",
+        ]
+        wheelhouse = os.getenv("WILMAWHEELHOUSE")
+        if wheelhouse:
+            args += ["--no-index", "--find-links", wheelhouse]
+        check_output(args + DEPENDENCIES, env=env)
+
+        try:
+            tmp.rename(deps)
+        except OSError:
+            # Another process has installed the same dependencies first.
+            if not deps.exists():
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if DEPS.exists():
+    deps = DEPS
+else:
+    deps = cache_dir() / "bootstrap" / bootstrap_key()
+    if not deps.exists():
+        # Install Wilma dependencies in isolation
+        try:
+            install(deps)
+        except Exception:
+            LOGGER.error("Failed to install dependencies", exc_info=True)
+            raise
+
+# The Wilma dependencies are kept off the path of the application, and are
+# only made available to Wilma itself.
+wilma_deps = site.getsitepackages(prefixes=[str(deps.resolve())])
+
+# The modules that Wilma loaded, kept out of sys.modules so that the
+# application loads its own copies of any modules they have in common.
+wilma_modules: t.Dict[str, ModuleType] = {}
+
+
+@contextmanager
+def dependencies() -> t.Iterator[None]:
+    """Make the Wilma dependencies, and the modules loaded from them, importable.
+
+    Any modules that are loaded in the meantime are taken out of sys.modules
+    again afterwards, together with the dependencies.
+    """
+    loaded = set(sys.modules)
+    for name, module in wilma_modules.items():
+        sys.modules.setdefault(name, module)
+    sys.path[0:0] = wilma_deps
+    try:
+        yield
+    finally:
+        # Other paths, like the ones of the dependencies of the probes, might
+        # have been added in front of the Wilma dependencies.
+        sys.path[:] = [_ for _ in sys.path if _ not in wilma_deps]
+        for name in set(sys.modules) - loaded:
+            wilma_modules[name] = sys.modules.pop(name)
 
 
 @contextmanager
@@ -73,29 +161,130 @@ class WilmaException(Exception):
     pass
 
 
+class LazyModuleWatchdog(object):
+    """Load the probes when the first module that might have probes is imported.
+
+    This is a meta path finder that looks at the names of the modules that are
+    being imported, and never finds any module itself. When a module matches
+    the locations of the probes, the machinery that injects the probes is
+    loaded, and the module is handed over to the Wilma module watchdog.
+    """
+
+    def __init__(self, locations: "ProbeLocations") -> None:
+        self.locations = locations
+        self._finding: t.Set[str] = set()
+
+    def _origin(self, fullname: str) -> t.Optional[str]:
+        try:
+            spec = find_spec(fullname)
+        except Exception:
+            return None
+        return getattr(spec, "origin", None)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname in self._finding:
+            return None
+
+        self._finding.add(fullname)
+        try:
+            if not self.locations.matches(fullname, lambda: self._origin(fullname)):
+                return None
+
+            try:
+                watchdog = load(wilmaenv.wilmaconfig)
+            except Exception:
+                LOGGER.error("Failed to load the probes", exc_info=True)
+                return None
+
+            # The Wilma module watchdog was not there when the import started.
+            return watchdog.find_spec(fullname, path, target)
+
+        finally:
+            self._finding.discard(fullname)
+
+
+def _loaded(locations: "ProbeLocations") -> bool:
+    # Whether any of the modules that are already loaded might have probes.
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if locations.matches(
+            name, lambda: os.path.abspath(filename) if filename else None
+        ):
+            return True
+    return False
+
+
+_lock = threading.RLock()
+_on_config_changed: t.Optional[t.Callable[[dict], None]] = None
+
+
+def load(config: dict) -> t.Any:
+    """Load the machinery that injects the probes, and apply the configuration.
+
+    Returns the Wilma module watchdog.
+    """
+    global _on_config_changed
+
+    with _lock:
+        with dependencies():
+            import wilma._bootstrap.run_module  # noqa
+            import wilma._tools  # noqa
+            from wilma._inject import WilmaModuleWatchdog
+            from wilma._inject import on_config_changed
+
+            if _on_config_changed is None:
+                for finder in list(sys.meta_path):
+                    if isinstance(finder, LazyModuleWatchdog):
+                        sys.meta_path.remove(finder)
+
+                WilmaModuleWatchdog.install()
+                atexit.register(WilmaModuleWatchdog.uninstall)
+
+                _on_config_changed = on_config_changed
+                on_config_changed(config)
+
+        return WilmaModuleWatchdog._instance
+
+
+def on_config_changed(config: dict) -> None:
+    with _lock:
+        if _on_config_changed is not None:
+            _on_config_changed(config)
+            return
+
+        # The probes are not loaded yet, so we only need to know where they are.
+        locations = ProbeLocations(config)
+        for finder in sys.meta_path:
+            if isinstance(finder, LazyModuleWatchdog):
+                finder.locations = locations
+        if locations and _loaded(locations):
+            load(config)
+
+
 try:
-    # Set verbosity level
-    if wilmaenv.verbose:
-        logging.basicConfig(level=logging.INFO)
+    with dependencies():
+        from wilma._config import wilmaenv
+        from wilma._locations import ProbeLocations
 
-    # Install module watchdog
-    try:
-        WilmaModuleWatchdog.install()
-    except RuntimeError:
-        pass
-    atexit.register(WilmaModuleWatchdog.uninstall)
+        # Set verbosity level
+        if wilmaenv.verbose:
+            logging.basicConfig(level=logging.INFO)
+
+        # Create the Wilma prefix directory
+        wilmaenv.wilmaprefix.mkdir(exist_ok=True)
 
-    # Create the Wilma prefix directory
-    wilmaenv.wilmaprefix.mkdir(exist_ok=True)
+        config = wilmaenv.wilmaconfig
+        locations = ProbeLocations(config)
 
-    # Listen for changes to the Wilma file
-    wilmaenv.observe(on_config_changed)
+        # Listen for changes to the Wilma file, if there is anything to change.
+        if config.get("probes") or config.get("imports"):
+            wilmaenv.observe(on_config_changed)
 
-    # Initial configuration
-    on_config_changed(wilmaenv.wilmaconfig)
+    if locations and _loaded(locations):
+        load(config)
+    else:
+        # Wait for the first module that might have probes.
+        sys.meta_path.insert(0, LazyModuleWatchdog(locations))  # type: ignore
 
 except WilmaException:
     LOGGER.error("Cannot initialise Wilma", exc_info=True)
-
-# Remove Wilma dependencies from the path
-sys.path[: len(wilma_deps)] = []
@@ -1,55 +1,89 @@
 import runpy
 import typing as t
+from dis import findlinestarts
 from traceback import print_tb
 from types import CodeType
 
 from bytecode import Bytecode
-from bytecode import Instr
 from ddtrace.internal.injection import _inject_hook
 from ddtrace.internal.utils import get_argument_value
 
+from wilma._codecache import replace_consts
 from wilma._inject import Probe
 from wilma._inject import _wilma
+from wilma._inject import code_cache
 
 
-def instrs(code: Bytecode) -> t.Iterator[Instr]:
-    return (_ for _ in code if isinstance(_, Instr))
+def linenos(code: CodeType) -> t.Set[int]:
+    # Read the line numbers straight from the line table of the code object.
+    # This is much cheaper than decoding the bytecode.
+    try:
+        return {lineno for _, _, lineno in code.co_lines() if lineno is not None}
+    except AttributeError:
+        # Python < 3.10
+        return {lineno for _, lineno in findlinestarts(code)}
+
+
+def _transform_code(code: CodeType, probes: t.Dict[int, t.List[Probe]]) -> CodeType:
+    # We know that everything in a module is defined by executing the bytecode
+    # from a code object, so we can conveniently look at the constants to build
+    # a tree of code objects that we can recursively iterate upon. Code objects
+    # that do not need rewriting are returned as they are.
+    consts = tuple(
+        _transform_code(c, probes) if isinstance(c, CodeType) else c
+        for c in code.co_consts
+    )
+    if any(new is not old for new, old in zip(consts, code.co_consts)):
+        code = replace_consts(code, consts)
+
+    probe_linenos = linenos(code) & probes.keys()
+    if not probe_linenos:
+        # No probes on the lines of this code object, so we don't need to
+        # decode its bytecode.
+        return code
+
+    acode = Bytecode.from_code(code)
+
+    for lineno in sorted(probe_linenos):
+        # We inject the hooks only if the probes are on a line that belongs to
+        # this code object.
+        for probe in probes[lineno]:
+            _inject_hook(acode, _wilma, lineno, probe)
+            Probe.__injected__.add(probe)
+
+    # Return the new code object.
+    return acode.to_code()
 
 
 def transform_code(code: CodeType, module_origin: str) -> CodeType:
-    # Transform a module code object recursively. We know that everything in a
-    # module is defined by executing the bytecode from a code object, so we can
-    # conveniently look at instruction arguments to build a tree of code objects
-    # that we can recursevely iterate upon.
-    acode = Bytecode.from_code(code)
+    # Transform a module code object recursively.
 
     # Select the probes that apply to the run module.
-    # TODO: Add indexing to optimise this lookup.
-    probes = [p for p in Probe.__all__ if p.filename == module_origin]
+    probes = Probe.__all__.by_origin(module_origin)
     if not probes:
         # We don't have probes for the run module, so we return the original
         # code object.
         return code
 
-    linenos = {instr.lineno for instr in instrs(acode)}
-    for probe in probes:
-        # TODO: Add indexing to optimise this lookup.
-        if probe.lineno not in linenos:
-            continue
-
-        # We inject the hook only if the probe is on a line that belongs to this
-        # code object.
-        _inject_hook(acode, _wilma, probe.lineno, probe)
-        Probe.__injected__.add(probe)
-
-    # Scan all the instructions to find any code objects in the arguments that
-    # we should recurse upon to make sure that we look at the whole run module.
-    for i in instrs(acode):
-        if isinstance(i.arg, CodeType):
-            i.arg = transform_code(i.arg, module_origin)
-
-    # Return the new code object.
-    return acode.to_code()
+    # Look for the instrumented code in the code cache first.
+    ordered = sorted(
+        (probe for line_probes in probes.values() for probe in line_probes),
+        key=lambda probe: (probe.lineno, repr(probe.key)),
+    )
+    objects = [_wilma] + ordered
+    key = code_cache.key(code, ordered)
+    if key is not None:
+        cached = code_cache.get(key, objects)
+        if cached is not None:
+            new_code, used = cached
+            Probe.__injected__.update(objects[j] for j in used if j)
+            return new_code
+
+    new_code = _transform_code(code, probes)
+    if key is not None:
+        code_cache.put(key, new_code, objects)
+
+    return new_code
 
 
 def _wrapped_run_code(*args, **kwargs):
@@ -0,0 +1,161 @@
+import threading
+import typing as t
+from time import perf_counter_ns
+from time import process_time_ns
+
+
+THROTTLE = "throttle"
+EJECT = "eject"
+ACTIONS = (THROTTLE, EJECT)
+
+MAXSAMPLE = 1 << 20
+
+
+class OverheadBudget(object):
+    """The overhead that each probe is allowed to add to the process.
+
+    The budget is given either in microseconds of wall time spent in a probe
+    per second, or as a percentage of the CPU time of the process, or both.
+    Probes that go over budget are either throttled or ejected, depending on
+    the action.
+    """
+
+    def __init__(
+        self,
+        us_per_s: t.Optional[float] = None,
+        cpu_percent: t.Optional[float] = None,
+        window: float = 1.0,
+        action: str = THROTTLE,
+    ) -> None:
+        if us_per_s is None and cpu_percent is None:
+            raise ValueError("expected one of us_per_s, cpu_percent")
+        if action not in ACTIONS:
+            raise ValueError(
+                "unknown action '%s'. Expected one of %s" % (action, ", ".join(ACTIONS))
+            )
+        if window <= 0:
+            raise ValueError("the window must be positive")
+
+        self.us_per_s = float(us_per_s) if us_per_s is not None else None
+        self.cpu_percent = float(cpu_percent) if cpu_percent is not None else None
+        self.window = float(window)
+        self.action = action
+
+    @classmethod
+    def from_config(cls, config: dict) -> "OverheadBudget":
+        return cls(
+            us_per_s=config.get("us_per_s"),
+            cpu_percent=config.get("cpu_percent"),
+            window=config.get("window", 1.0),
+            action=config.get("action", THROTTLE),
+        )
+
+    @property
+    def key(self) -> t.Tuple[t.Any, ...]:
+        return (self.us_per_s, self.cpu_percent, self.window, self.action)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, OverheadBudget) and self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+
+class ProbeOverhead(object):
+    """Overhead accounting for a single probe.
+
+    The wall and CPU time spent in the probe are accumulated over a window.
+    At the end of every window, the overhead is checked against the budget.
+    Throttled probes fire on one hit every ``sample``, which is doubled for
+    every window that is over budget, and halved for every window that is well
+    within it. Ejected probes never fire again.
+
+    DEV: The accumulators are updated without a lock, so concurrent updates
+    might occasionally be lost. This is fine for the purpose of estimating the
+    overhead.
+    """
+
+    def __init__(self, budget: OverheadBudget) -> None:
+        self.budget = budget
+
+        self.sample = 1
+        self.exhausted = False
+        self.last_usage = (0.0, 0.0)
+
+        self._hits = 0
+        self._wall = 0
+        self._cpu = 0
+        self._window = int(budget.window * 1e9)
+        self._start = perf_counter_ns()
+        self._process_start = process_time_ns()
+        self._lock = threading.Lock()
+
+    def skip(self) -> bool:
+        if self.exhausted:
+            return True
+
+        if self.sample > 1:
+            self._hits += 1
+            return self._hits % self.sample != 0
+
+        return False
+
+    def usage(self, now: int) -> t.Tuple[float, float]:
+        """The overhead of the current window.
+
+        Returns the wall time in microseconds per second and the percentage of
+        the CPU time of the process.
+        """
+        elapsed = now - self._start
+        process = process_time_ns() - self._process_start
+        return (
+            self._wall * 1e6 / elapsed if elapsed else 0.0,
+            self._cpu * 100.0 / process if process else 0.0,
+        )
+
+    def record(self, wall: int, cpu: int) -> t.Optional[str]:
+        """Record the time spent in a single hit of the probe.
+
+        Returns the action to take if the probe went over budget.
+        """
+        self._wall += wall
+        self._cpu += cpu
+
+        now = perf_counter_ns()
+        if now - self._start < self._window or not self._lock.acquire(False):
+            return None
+
+        try:
+            us_per_s, cpu_percent = self.usage(now)
+            budget = self.budget
+            ratio = max(
+                us_per_s / budget.us_per_s if budget.us_per_s is not None else 0.0,
+                (
+                    cpu_percent / budget.cpu_percent
+                    if budget.cpu_percent is not None
+                    else 0.0
+                ),
+            )
+
+            self._wall = self._cpu = 0
+            self._start = now
+            self._process_start = process_time_ns()
+
+            self.last_usage = (us_per_s, cpu_percent)
+
+            if ratio <= 1.0:
+                # Leave some headroom before sampling back up, or we would
+                # keep going over budget.
+                if ratio < 0.25 and self.sample > 1:
+                    self.sample >>= 1
+                return None
+
+            if budget.action == EJECT:
+                self.exhausted = True
+            elif self.sample < MAXSAMPLE:
+                self.sample <<= 1
+
+            return budget.action
+
+        finally:
+            self._lock.release()
@@ -1,3 +1,4 @@
+import atexit
 import os
 import sys
 import threading
@@ -7,12 +8,20 @@ from itertools import chain
 from itertools import islice
 from types import FrameType
 
-from ddtrace.debugging.safety import get_fields
 from ddtrace.internal.compat import BUILTIN_CONTAINER_TYPES
 from ddtrace.internal.compat import BUILTIN_SIMPLE_TYPES
 
 from wilma._config import wilmaenv
+from wilma._delta import DELTA_CACHE_SIZE
+from wilma._delta import DeltaEncoder
+from wilma._stack import Stack
+from wilma._stack import StackTable
+from wilma._stack import walk_stack
+from wilma._writer import WRITERS
+from wilma._writer import AsyncWriter
+from wilma._writer import FileWriter
 from wilma._writer import JsonFileWriter
+from wilma._writer import RingFileWriter
 
 
 NoneType = type(None)
@@ -24,6 +33,93 @@ MAXLEN = 255
 MAXFIELDS = 20
 MAXOBJECTS = 500
 
+# How much of a snapshot is taken on the thread that captures it. With a full
+# snapshot, the whole object graph is captured straight away. With a shallow
+# one, mutable containers are copied and the graph is expanded later by the
+# capture writer. With none, only references to the objects are taken.
+FULL = "full"
+SHALLOW = "shallow"
+NONE = "none"
+CONSISTENCY_LEVELS = (FULL, SHALLOW, NONE)
+
+
+def _dict_fields(obj: t.Any) -> t.Dict[str, t.Any]:
+    try:
+        __dict__ = object.__getattribute__(obj, "__dict__")
+    except Exception:
+        return {}
+    return __dict__ if type(__dict__) is dict else {}
+
+
+def _slot_names(_type: type) -> t.Iterator[t.Tuple[type, str]]:
+    for cls in _type.__mro__:
+        try:
+            slots = cls.__dict__["__slots__"]
+        except KeyError:
+            continue
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if name in ("__dict__", "__weakref__"):
+                continue
+            if name.startswith("__") and not name.endswith("__"):
+                # Private slot names are mangled
+                name = "_%s%s" % (cls.__name__.lstrip("_"), name)
+            yield cls, name
+
+
+def _slots_fields(
+    descriptors: t.Tuple[t.Tuple[str, t.Any], ...]
+) -> t.Callable[[t.Any], t.Dict[str, t.Any]]:
+    def fields(obj: t.Any) -> t.Dict[str, t.Any]:
+        result = {}
+        for name, descriptor in descriptors:
+            try:
+                result[name] = descriptor.__get__(obj, None)
+            except AttributeError:
+                # The slot is not set
+                pass
+        return result
+
+    return fields
+
+
+_field_accessors: "weakref.WeakKeyDictionary[type, t.Tuple[tuple, t.Callable]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def field_accessor(_type: type) -> t.Callable[[t.Any], t.Dict[str, t.Any]]:
+    """Get the field accessor for objects of the given type.
+
+    The type introspection is performed once per type. The result is cached
+    and invalidated when the MRO of the type changes.
+    """
+    mro = _type.__mro__
+    try:
+        cached_mro, accessor = _field_accessors[_type]
+        if cached_mro is mro:
+            return accessor
+    except KeyError:
+        pass
+
+    if _type.__dictoffset__:
+        accessor = _dict_fields
+    else:
+        accessor = _slots_fields(
+            tuple(
+                (name, cls.__dict__[name])
+                for cls, name in _slot_names(_type)
+                if name in cls.__dict__
+            )
+        )
+
+    try:
+        _field_accessors[_type] = (mro, accessor)
+    except TypeError:
+        # Not weak-referenceable
+        pass
+
+    return accessor
+
 
 class CaptureContext:
     def __init__(
@@ -34,26 +130,37 @@ class CaptureContext:
         maxsize=MAXSIZE,
         maxfields=MAXFIELDS,
         maxobjects=MAXOBJECTS,
+        f_locals: t.Optional[t.Dict[str, t.Any]] = None,
+        probe: t.Optional[str] = None,
     ):
         self.frame = frame or sys._getframe(1)
+        self.probe = probe
         self.maxlevel = level
         self.maxlen = maxlen
         self.maxsize = maxsize
         self.maxfields = maxfields
         self.maxobjects = maxobjects
 
-        self._locals = {name: id(item) for (name, item) in frame.f_locals.items()}
+        if f_locals is None:
+            f_locals = self.frame.f_locals
+        self._locals = {name: self.object_id(item) for (name, item) in f_locals.items()}
         self._watches = {}
 
-        self.to_capture = [(item, level) for item in frame.f_locals.values()]
+        self.to_capture = [(item, level) for item in f_locals.values()]
 
         self.captured = {}
         self.capturedSize = 0
 
     def add_watch(self, name, object):
-        self._watches[name] = id(object)
+        self._watches[name] = self.object_id(object)
         self.to_capture.append((object, 0))
 
+    def object_id(self, value: t.Any) -> int:
+        return id(value)
+
+    def size(self, _id: int, value: t.Any) -> int:
+        return len(value)
+
     def capture_value(self, _id, value, level: int):
         _type = type(value)
 
@@ -87,7 +194,7 @@ class CaptureContext:
                         "id": _id,
                         "type": _type.__qualname__,
                         "notCapturedReason": "depth",
-                        "size": len(value),
+                        "size": self.size(_id, value),
                     },
                     [],
                 )
@@ -100,12 +207,12 @@ class CaptureContext:
                     "type": "dict",
                     "entries": [
                         (
-                            id(item[0]),
-                            id(item[1]),
+                            self.object_id(item[0]),
+                            self.object_id(item[1]),
                         )
                         for item in items
                     ],
-                    "size": len(value),
+                    "size": self.size(_id, value),
                 }
                 if level > 0:
                     to_capture = chain(
@@ -117,33 +224,35 @@ class CaptureContext:
 
             else:
                 # Sequence
+                elements = list(islice(value, self.maxsize))
                 data = {
                     "id": _id,
                     "type": _type.__qualname__,
-                    "elements": [id(v) for v in value[: self.maxsize]],
-                    "size": len(value),
+                    "elements": [self.object_id(v) for v in elements],
+                    "size": self.size(_id, value),
                 }
                 if level > 0:
-                    to_capture = [(v, level - 1) for v in value[: self.maxsize]]
+                    to_capture = [(v, level - 1) for v in elements]
                 else:
                     to_capture = []
 
-            if len(value) > self.maxsize:
+            if data["size"] > self.maxsize:
                 data["notCapturedReason"] = "collectionSize"
 
             return (data, to_capture)
 
-        fields = get_fields(value)
+        fields = field_accessor(_type)(value)
         data = {
             "id": _id,
             "type": _type.__qualname__,
             "fields": {
-                n: id(v) for _, (n, v) in zip(range(self.maxfields), fields.items())
+                n: self.object_id(v)
+                for _, (n, v) in zip(range(self.maxfields), fields.items())
             },
         }
 
         to_capture = [
-            (v, level - 1) for v in zip(range(self.maxfields), fields.values())
+            (v, level - 1) for _, v in zip(range(self.maxfields), fields.values())
         ]
 
         if len(fields) > self.maxfields:
@@ -154,12 +263,12 @@ class CaptureContext:
     def capture(self):
         while self.capturedSize < self.maxobjects and len(self.to_capture) > 0:
             (obj, level) = self.to_capture.pop()
-            _id = id(obj)
+            _id = self.object_id(obj)
             (captured, to_capture) = self.capture_value(_id, obj, level)
 
             self.captured[_id] = captured
             for obj_and_level in to_capture:
-                to_capture_id = id(obj_and_level[0])
+                to_capture_id = self.object_id(obj_and_level[0])
                 if to_capture_id not in self.captured:
                     self.to_capture.append(obj_and_level)
 
@@ -168,29 +277,15 @@ class CaptureContext:
         # remove all left overs
         self.to_capture.clear()
 
-    def capture_stack(self):
-        frame = self.frame
-        stack = []
-        h = 0
-        while frame and h < self.maxsize:
-            code = frame.f_code
-            stack.append(
-                {
-                    "fileName": code.co_filename,
-                    "function": code.co_name,
-                    "lineNumber": frame.f_lineno,
-                }
-            )
-            frame = frame.f_back
-            h += 1
-        return stack
+    def capture_stack(self) -> Stack:
+        return walk_stack(self.frame, self.maxsize)
 
     def capture_thread(self):
         thread = threading.current_thread()
         return dict(fid=id(self.frame), tid=thread.ident, pid=os.getpid())
 
     def to_json(self):
-        return dict(
+        snapshot = dict(
             type="snapshot",
             locals=self._locals,
             watches=self._watches,
@@ -198,10 +293,157 @@ class CaptureContext:
             stack=self.capture_stack(),
             **self.capture_thread(),
         )
+        if self.probe is not None:
+            snapshot["probe"] = self.probe
+        return snapshot
+
+
+class DeferredCaptureContext(CaptureContext):
+    """Capture context that defers the expansion of the snapshot.
+
+    Only a bounded snapshot of the frame locals, the watches and the stack is
+    taken on the thread that creates the context. With a shallow snapshot,
+    mutable containers are copied, up to the maximum collection size; every
+    other object is referenced. The object graph is expanded when the context
+    is serialised, which is meant to happen on the capture writer thread.
+
+    The copies are reported with the id of the original containers, so that
+    the snapshots of the same objects can be delta-encoded.
+    """
+
+    def __init__(self, frame: FrameType, shallow: bool = True, **kwargs: t.Any):
+        self._sizes: t.Dict[int, int] = {}
+        # The original containers of the copies, by the id of the copies. They
+        # are kept alive with the context, so that their ids are not reused.
+        self._originals: t.Dict[int, t.Any] = {}
+        self._shallow = shallow
+        self.maxsize = kwargs.get("maxsize", MAXSIZE)
+
+        super().__init__(
+            frame,
+            f_locals={name: self._copy(v) for name, v in frame.f_locals.items()},
+            **kwargs,
+        )
+
+        self._stack = walk_stack(frame, self.maxsize)
+        self._thread = super().capture_thread()
+
+        # Do not keep the frame, and hence all its locals, alive.
+        self.frame = None
+
+    def _copy(self, value: t.Any) -> t.Any:
+        if not self._shallow:
+            return value
+
+        _type = type(value)
+        if _type is list or _type is set:
+            copy = _type(islice(value, self.maxsize))
+        elif _type is dict:
+            copy = dict(islice(value.items(), self.maxsize))
+        else:
+            return value
+
+        # Keep track of the original container and of its size.
+        self._originals[id(copy)] = value
+        self._sizes[id(value)] = len(value)
+        return copy
+
+    def object_id(self, value: t.Any) -> int:
+        _id = id(value)
+        return id(self._originals[_id]) if _id in self._originals else _id
+
+    def size(self, _id: int, value: t.Any) -> int:
+        return self._sizes.get(_id, len(value))
+
+    def add_watch(self, name, object):
+        super().add_watch(name, self._copy(object))
+
+    def capture_stack(self) -> Stack:
+        return self._stack
+
+    def capture_thread(self):
+        return self._thread
+
+    def to_json(self):
+        self.capture()
+        return super().to_json()
 
 
 _watches = {}
-_capture_writers: t.List[t.Callable] = [JsonFileWriter(wilmaenv.captures_path)]
+_capture_writers: t.List[t.Callable] = []
+_consistency = FULL
+
+
+def _file_writer(settings: dict) -> FileWriter:
+    delta = (
+        DeltaEncoder(int(settings.get("delta_cache_size", DELTA_CACHE_SIZE)))
+        if settings.get("delta", False)
+        else None
+    )
+    stacks = StackTable() if settings.get("intern_stacks", False) else None
+
+    capture_format = settings.get("format", "json")
+    try:
+        writer_class = WRITERS[capture_format]
+    except KeyError:
+        raise ValueError(
+            "unknown format '%s'. Expected one of %s"
+            % (capture_format, ", ".join(WRITERS))
+        )
+
+    # Other formats are written to the file with their name as the extension.
+    paths = {
+        "json": wilmaenv.captures_path,
+        "binary": wilmaenv.binary_captures_path,
+    }
+    path = paths.get(
+        capture_format, wilmaenv.wilmaprefix / f"captures.{capture_format}"
+    )
+
+    return writer_class(path, delta, stacks)
+
+
+def _writer(settings: dict) -> t.Union[AsyncWriter, RingFileWriter]:
+    sink = settings.get("sink", "file")
+    if sink == "ring":
+        for setting in ("delta", "intern_stacks"):
+            if settings.get(setting, False):
+                # Records in the ring are overwritten, so they must be
+                # self-contained.
+                print(f"wilma: the ring sink does not support {setting}. Ignoring.")
+        # The ring size is given in MB
+        return RingFileWriter(
+            wilmaenv.ring_captures_path,
+            int(float(settings.get("ring_size", 16)) * (1 << 20)),
+            binary=settings.get("format", "json") == "binary",
+        )
+    if sink != "file":
+        raise ValueError("unknown sink '%s'. Expected one of file, ring" % sink)
+
+    return AsyncWriter.from_config(_file_writer(settings), settings)
+
+
+def _writers() -> t.List[t.Callable]:
+    global _consistency
+
+    if not _capture_writers:
+        settings = wilmaenv.wilmaconfig.get("captures", {})
+        try:
+            consistency = settings.get("consistency", FULL)
+            if consistency not in CONSISTENCY_LEVELS:
+                raise ValueError(
+                    "unknown consistency '%s'. Expected one of %s"
+                    % (consistency, ", ".join(CONSISTENCY_LEVELS))
+                )
+            writer = _writer(settings)
+            _consistency = consistency
+        except (TypeError, ValueError) as e:
+            print(f"wilma: invalid capture settings: {e}. Using defaults.")
+            writer = AsyncWriter(JsonFileWriter(wilmaenv.captures_path))
+        atexit.register(writer.close, exiting=True)
+        _capture_writers.append(writer)
+
+    return _capture_writers
 
 
 def watch(name: str, value: t.Any):
@@ -211,10 +453,21 @@ def watch(name: str, value: t.Any):
 
 def capture():
     frame = sys._getframe(4)  # get caller frame
-    context = CaptureContext(frame)
-    for name, w in _watches:
+    location = sys._getframe(2).f_locals["self"].location
+    writers = _writers()
+    context = (
+        CaptureContext(frame, probe=location)
+        if _consistency == FULL
+        else DeferredCaptureContext(
+            frame, shallow=_consistency == SHALLOW, probe=location
+        )
+    )
+    for name, w in _watches.items():
         context.add_watch(name, w)
-    context.capture()
-    capture = context.to_json()
-    for output in _capture_writers:
+    if _consistency == FULL:
+        context.capture()
+        capture = context.to_json()
+    else:
+        capture = context
+    for output in writers:
         output(capture)
@@ -0,0 +1,296 @@
+"""Compact binary encoding of captures.
+
+A binary captures file is a sequence of sessions, one for each process that
+appended to it. Every session starts with a header and is followed by a stream
+of length-prefixed records::
+
+    record := tag:u8 length:varint payload
+
+String records define the next entry of the session string table. Capture
+records hold a single encoded value, where dictionary keys and the values of
+the fields in ``INTERNED_FIELDS`` are references into the string table. All
+the integers, including object ids, are encoded as zig-zag varints.
+"""
+
+import json
+import struct
+import typing as t
+from io import BytesIO
+
+from wilma._delta import DeltaDecoder
+from wilma._ring import RING_MAGIC
+from wilma._ring import is_ring
+from wilma._ring import records
+
+
+MAGIC = b"WILMA\x00\x01"
+
+# Record tags
+STRING = 0x01
+CAPTURE = 0x02
+
+# Value tags
+NONE = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT = 0x03
+FLOAT = 0x04
+REF = 0x05
+STR = 0x06
+LIST = 0x07
+DICT = 0x08
+
+# The values of these fields are drawn from a small set of strings, e.g. type
+# names, so we intern them.
+INTERNED_FIELDS = frozenset({"type", "fileName", "function", "notCapturedReason"})
+
+MAXSTRINGS = 1 << 16
+
+_double = struct.Struct("<d")
+
+
+class DecodeError(Exception):
+    pass
+
+
+def write_varint(buffer: bytearray, n: int) -> None:
+    while n > 0x7F:
+        buffer.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buffer.append(n)
+
+
+def read_varint(data: bytes, pos: int) -> t.Tuple[int, int]:
+    n = shift = 0
+    try:
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n, pos
+            shift += 7
+    except IndexError:
+        raise DecodeError("Truncated varint")
+
+
+def zigzag(n: int) -> int:
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+class BinaryEncoder(object):
+    """Stateful encoder of captures.
+
+    The encoder keeps the string table of the current session. Strings are
+    emitted in the output the first time they are interned.
+    """
+
+    def __init__(self) -> None:
+        self._strings: t.Dict[str, int] = {}
+
+    def header(self) -> bytes:
+        """Start a new session."""
+        self._strings.clear()
+        return MAGIC
+
+    def _intern(self, out: bytearray, value: str, payload: bytearray) -> bool:
+        try:
+            ref = self._strings[value]
+        except KeyError:
+            if len(self._strings) >= MAXSTRINGS:
+                return False
+            ref = self._strings[value] = len(self._strings)
+            data = value.encode("utf-8")
+            out.append(STRING)
+            write_varint(out, len(data))
+            out += data
+
+        payload.append(REF)
+        write_varint(payload, ref)
+        return True
+
+    def _value(self, out: bytearray, payload: bytearray, value: t.Any) -> None:
+        if value is None:
+            payload.append(NONE)
+        elif value is True:
+            payload.append(TRUE)
+        elif value is False:
+            payload.append(FALSE)
+        elif isinstance(value, int):
+            payload.append(INT)
+            write_varint(payload, zigzag(value))
+        elif isinstance(value, float):
+            payload.append(FLOAT)
+            payload += _double.pack(value)
+        elif isinstance(value, str):
+            data = value.encode("utf-8")
+            payload.append(STR)
+            write_varint(payload, len(data))
+            payload += data
+        elif isinstance(value, dict):
+            payload.append(DICT)
+            write_varint(payload, len(value))
+            for k, v in value.items():
+                k = str(k)
+                if not self._intern(out, k, payload):
+                    self._value(out, payload, k)
+                if k in INTERNED_FIELDS and isinstance(v, str):
+                    if self._intern(out, v, payload):
+                        continue
+                self._value(out, payload, v)
+        elif isinstance(value, (list, tuple)):
+            payload.append(LIST)
+            write_varint(payload, len(value))
+            for v in value:
+                self._value(out, payload, v)
+        else:
+            self._value(out, payload, repr(value))
+
+    def encode(self, capture: dict) -> bytes:
+        """Encode a capture, together with any new strings it requires."""
+        out = bytearray()
+        payload = bytearray()
+
+        self._value(out, payload, capture)
+
+        out.append(CAPTURE)
+        write_varint(out, len(payload))
+        out += payload
+
+        return bytes(out)
+
+
+class BinaryDecoder(object):
+    """Streaming decoder of binary captures files."""
+
+    def __init__(self) -> None:
+        self._strings: t.List[str] = []
+
+    def _value(self, data: bytes, pos: int) -> t.Tuple[t.Any, int]:
+        tag = data[pos]
+        pos += 1
+
+        if tag == NONE:
+            return None, pos
+        if tag == TRUE:
+            return True, pos
+        if tag == FALSE:
+            return False, pos
+        if tag == INT:
+            n, pos = read_varint(data, pos)
+            return unzigzag(n), pos
+        if tag == FLOAT:
+            return _double.unpack_from(data, pos)[0], pos + _double.size
+        if tag == REF:
+            ref, pos = read_varint(data, pos)
+            try:
+                return self._strings[ref], pos
+            except IndexError:
+                raise DecodeError("Unknown string reference %d" % ref)
+        if tag == STR:
+            n, pos = read_varint(data, pos)
+            return data[pos : pos + n].decode("utf-8"), pos + n
+        if tag == LIST:
+            n, pos = read_varint(data, pos)
+            items = []
+            for _ in range(n):
+                item, pos = self._value(data, pos)
+                items.append(item)
+            return items, pos
+        if tag == DICT:
+            n, pos = read_varint(data, pos)
+            mapping = {}
+            for _ in range(n):
+                k, pos = self._value(data, pos)
+                mapping[k], pos = self._value(data, pos)
+            return mapping, pos
+
+        raise DecodeError("Unknown value tag 0x%02x" % tag)
+
+    def decode(self, stream: t.BinaryIO) -> t.Iterator[dict]:
+        """Decode the captures from the given stream, one record at a time."""
+        while True:
+            head = stream.read(1)
+            if not head:
+                return
+
+            if head == MAGIC[:1]:
+                rest = stream.read(len(MAGIC) - 1)
+                if head + rest != MAGIC:
+                    raise DecodeError("Invalid session header")
+                self._strings = []
+                continue
+
+            tag = head[0]
+            length = 0
+            shift = 0
+            while True:
+                b = stream.read(1)
+                if not b:
+                    raise DecodeError("Truncated record")
+                length |= (b[0] & 0x7F) << shift
+                if b[0] < 0x80:
+                    break
+                shift += 7
+
+            payload = stream.read(length)
+            if len(payload) < length:
+                raise DecodeError("Truncated record")
+
+            if tag == STRING:
+                self._strings.append(payload.decode("utf-8"))
+            elif tag == CAPTURE:
+                capture, _ = self._value(payload, 0)
+                yield capture
+            else:
+                raise DecodeError("Unknown record tag 0x%02x" % tag)
+
+
+def _peek(stream: t.BinaryIO, n: int) -> bytes:
+    pos = stream.tell()
+    try:
+        return stream.read(n)
+    finally:
+        stream.seek(pos)
+
+
+def _decode(stream: t.BinaryIO) -> t.Iterator[dict]:
+    head = _peek(stream, max(len(MAGIC), len(RING_MAGIC)))
+
+    if is_ring(head):
+        for record in records(stream.read()):
+            yield from _decode(BytesIO(record))
+        return
+
+    if head.startswith(MAGIC):
+        yield from BinaryDecoder().decode(stream)
+        return
+
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def decode(stream: t.BinaryIO) -> t.Iterator[dict]:
+    """Decode captures from a ring, binary or JSON lines captures stream.
+
+    Delta-encoded snapshots are rebuilt in full and interned stacks are
+    resolved.
+    """
+    delta = DeltaDecoder()
+    stacks: t.Dict[t.Tuple[t.Any, int], t.List[dict]] = {}
+    for capture in _decode(stream):
+        if capture.get("type") == "stack":
+            stacks[(capture.get("pid"), capture["id"])] = capture["frames"]
+            continue
+
+        if "stackId" in capture:
+            capture = dict(capture)
+            key = (capture.get("pid"), capture.pop("stackId"))
+            capture["stack"] = stacks.get(key, [])
+
+        yield delta.decode(capture)
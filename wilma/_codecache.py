@@ -0,0 +1,208 @@
+"""On-disk cache of instrumented code objects.
+
+Injecting probes means decompiling and recompiling the bytecode of the probed
+code objects, which is expensive. The instrumented code objects are therefore
+cached within the Wilma prefix, much like Python caches compiled modules in
+``__pycache__``, so that processes that start with the same code and the same
+probes skip the bytecode rewriting altogether.
+
+Like with ``__pycache__``, there is a single entry for every code object,
+which is named after the location of the code, and which is overwritten when
+the source or the probes change, so the cache does not grow with every edit.
+The entries are validated with the bytecode magic number of the interpreter,
+the marshalled original code object, which changes with the source, and the
+locations of the probes. The hook and the probes referenced by the instrumented
+code cannot be marshalled, so they are replaced by placeholders. Their positions
+are stored with the entry, and the actual objects are put back in place when
+the entry is loaded.
+"""
+
+import hashlib
+import logging
+import marshal
+import os
+import typing as t
+from importlib.util import MAGIC_NUMBER
+from pathlib import Path
+from types import CodeType
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The version of the layout of the cache entries
+FORMAT = b"WLC1"
+
+# The position of an object within a tree of code objects, given by the indices
+# of the nested code objects within the constants, the index of the constant
+# within the innermost code object, and the index of the object among the ones
+# that are put back.
+Slot = t.Tuple[t.Tuple[int, ...], int, int]
+
+# The name of the entry, given by the location of the code object, and the
+# digest of its content
+Key = t.Tuple[str, str]
+
+
+def replace_consts(code: CodeType, consts: t.Tuple[t.Any, ...]) -> CodeType:
+    try:
+        return code.replace(co_consts=consts)
+    except AttributeError:
+        # Python < 3.8
+        return CodeType(
+            code.co_argcount,
+            code.co_kwonlyargcount,
+            code.co_nlocals,
+            code.co_stacksize,
+            code.co_flags,
+            code.co_code,
+            consts,
+            code.co_names,
+            code.co_varnames,
+            code.co_filename,
+            code.co_name,
+            code.co_firstlineno,
+            code.co_lnotab,
+            code.co_freevars,
+            code.co_cellvars,
+        )
+
+
+def _strip(
+    code: CodeType,
+    objects: t.Sequence[t.Any],
+    slots: t.List[Slot],
+    path: t.Tuple[int, ...] = (),
+) -> CodeType:
+    consts = list(code.co_consts)
+    for i, const in enumerate(consts):
+        if isinstance(const, CodeType):
+            consts[i] = _strip(const, objects, slots, path + (i,))
+            continue
+        for j, o in enumerate(objects):
+            if const is o:
+                slots.append((path, i, j))
+                consts[i] = None
+                break
+
+    return replace_consts(code, tuple(consts))
+
+
+def _fill(
+    code: CodeType,
+    objects: t.Sequence[t.Any],
+    slots: t.Dict[t.Tuple[int, ...], t.List[t.Tuple[int, int]]],
+    path: t.Tuple[int, ...] = (),
+) -> CodeType:
+    consts = list(code.co_consts)
+    for i, j in slots.get(path, []):
+        consts[i] = objects[j]
+    for i, const in enumerate(consts):
+        if isinstance(const, CodeType):
+            consts[i] = _fill(const, objects, slots, path + (i,))
+
+    return replace_consts(code, tuple(consts))
+
+
+class CodeCache(object):
+    """Cache of instrumented code objects.
+
+    Entries are looked up with the original code object and the locations of
+    the probes that are injected into it. The objects to put back into the
+    instrumented code are the hook followed by the probes.
+    """
+
+    def __init__(self, path: Path, salt: str = "") -> None:
+        self.path = path
+        # Anything else that affects the instrumented code, like the version of
+        # the bytecode injection library.
+        self.salt = salt.encode()
+
+    def key(self, code: CodeType, probes: t.Iterable[t.Any]) -> t.Optional[Key]:
+        try:
+            # Later versions of the format refer back to the objects that are
+            # shared within the process, so the same code object does not
+            # always marshal to the same bytes. The digest needs a stable
+            # encoding.
+            data = marshal.dumps(code, 2)
+        except ValueError:
+            # The code is instrumented already.
+            return None
+
+        # Different interpreters that share the cache must not overwrite each
+        # other's entries.
+        prefix = FORMAT + MAGIC_NUMBER + self.salt
+
+        location = hashlib.sha256(prefix)
+        location.update(
+            f"{code.co_filename}:{code.co_firstlineno}:{code.co_name}".encode()
+        )
+
+        digest = hashlib.sha256(prefix)
+        digest.update(data)
+        # The instrumented code only depends on where the probes are, not on
+        # what they do, so editing a probe statement keeps the entry valid.
+        for probe in probes:
+            digest.update(f"\0{probe.location}".encode())
+
+        return location.hexdigest(), digest.hexdigest()
+
+    def get(
+        self, key: Key, objects: t.Sequence[t.Any]
+    ) -> t.Optional[t.Tuple[CodeType, t.Set[int]]]:
+        """Load an instrumented code object.
+
+        Returns the code object, with the given objects put back in place, and
+        the indices of the objects that it references, or ``None`` if there is
+        no valid entry for the key.
+        """
+        name, digest = key
+        try:
+            data = (self.path / name).read_bytes()
+        except OSError:
+            return None
+
+        # The entry might be for an older version of the code, or for other
+        # probes.
+        header = FORMAT + MAGIC_NUMBER + digest.encode()
+        if not data.startswith(header):
+            return None
+
+        try:
+            code, slots = marshal.loads(data[len(header) :])
+            if not isinstance(code, CodeType):
+                raise TypeError("not a code object")
+
+            slots_by_path: t.Dict[t.Tuple[int, ...], t.List[t.Tuple[int, int]]] = {}
+            used = set()
+            for path, i, j in slots:
+                if not 0 <= j < len(objects):
+                    raise IndexError("object index out of range")
+                slots_by_path.setdefault(tuple(path), []).append((i, j))
+                used.add(j)
+
+            return _fill(code, objects, slots_by_path), used
+
+        except (EOFError, IndexError, TypeError, ValueError):
+            LOGGER.debug("Invalid code cache entry %s", name, exc_info=True)
+            return None
+
+    def put(self, key: Key, code: CodeType, objects: t.Sequence[t.Any]) -> None:
+        """Store an instrumented code object, replacing any previous one."""
+        slots: t.List[Slot] = []
+        try:
+            data = marshal.dumps((_strip(code, objects, slots), tuple(slots)))
+        except ValueError:
+            # The code references other objects that cannot be marshalled.
+            return
+
+        name, digest = key
+        entry = self.path / name
+        tmp = entry.with_name(f".{name}.{os.getpid()}")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(FORMAT + MAGIC_NUMBER + digest.encode() + data)
+            # Make the new entry visible atomically, so that concurrent
+            # processes never read partial entries.
+            os.replace(str(tmp), str(entry))
+        except OSError:
+            LOGGER.debug("Cannot write code cache entry %s", name, exc_info=True)
@@ -1,25 +1,91 @@
 import typing as t
+from hashlib import sha256
 from pathlib import Path
+from threading import Lock
+from threading import Thread
+from threading import Timer
 
-import toml
 from envier import En
-from watchdog.events import FileModifiedEvent
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
 
 
-class WilmaFileChangeEvent(FileSystemEventHandler):
-    def __init__(self, cb: t.Callable[[dict], None]) -> None:
-        super().__init__()
+if t.TYPE_CHECKING:
+    from watchdog.events import FileSystemEvent
+    from watchdog.observers import Observer
+
+
+def load_config(content: str) -> dict:
+    # The parser is only needed when there is a Wilma file.
+    import toml
+
+    return toml.loads(content)
+
+
+class WilmaFileChangeEvent(object):
+    """Reload the configuration when the Wilma file changes.
+
+    The parent directory of the Wilma file is watched, rather than the file
+    itself, to catch editors that save by writing a temporary file and renaming
+    it over the original one. Events for other files are discarded with a plain
+    string comparison. Editors emit several events for every save, so they are
+    coalesced into a single reload after a short delay. The configuration is
+    only parsed again if the content of the file has actually changed.
+
+    The observer only ever calls ``dispatch``, so this does not need to derive
+    from the watchdog event handlers, and watchdog is only imported when the
+    Wilma file is observed.
+    """
+
+    DELAY = 0.1  # seconds
+
+    # The type of the events of deleted files, i.e. EVENT_TYPE_DELETED
+    DELETED = "deleted"
+
+    def __init__(
+        self, path: Path, cb: t.Callable[[dict], None], delay: float = DELAY
+    ) -> None:
+        self.path = path
         self.cb = cb
+        self.delay = delay
 
-    def on_modified(self, event: FileModifiedEvent) -> None:
-        super().on_modified(event)
+        # The paths of the events are based on the watched directory, so they
+        # can be compared with the path of the Wilma file as strings.
+        self._path = str(path)
+        self._digest = self._read()[1]
+        self._timer: t.Optional[Timer] = None
+        self._lock = Lock()
 
-        if Path(event.src_path).resolve() != wilmaenv.wilmafile.resolve():
+    def _read(self) -> t.Tuple[t.Optional[bytes], t.Optional[str]]:
+        try:
+            content = self.path.read_bytes()
+        except OSError:
+            return None, None
+        return content, sha256(content).hexdigest()
+
+    def dispatch(self, event: "FileSystemEvent") -> None:
+        if event.is_directory or event.event_type == self.DELETED:
             return
 
-        new_config = toml.loads(wilmaenv.wilmafile.read_text())
+        if self._path not in (event.src_path, getattr(event, "dest_path", None)):
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = Timer(self.delay, self.reload)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def reload(self) -> None:
+        content, digest = self._read()
+        if content is None or digest == self._digest:
+            return
+        self._digest = digest
+
+        try:
+            new_config = load_config(content.decode())
+        except ValueError as e:
+            print(f"wilma: invalid configuration file {self.path}: {e}")
+            return
 
         try:
             return self.cb(new_config)
@@ -54,19 +120,33 @@ class WilmaConfig(En):
 
     wilmaconfig = En.d(
         dict,
-        lambda c: toml.loads(c.wilmafile.read_text()) if c.wilmafile.exists() else {},
+        lambda c: load_config(c.wilmafile.read_text()) if c.wilmafile.exists() else {},
     )
     metadata_path = En.d(Path, lambda c: c.wilmaprefix / "metadata.json")
+    deps_lock_path = En.d(Path, lambda c: c.wilmaprefix / "deps.lock")
     captures_path = En.d(Path, lambda c: c.wilmaprefix / "captures.log")
+    binary_captures_path = En.d(Path, lambda c: c.wilmaprefix / "captures.bin")
+    ring_captures_path = En.d(Path, lambda c: c.wilmaprefix / "captures.ring")
+    metrics_path = En.d(Path, lambda c: c.wilmaprefix / "metrics.log")
+    code_cache_path = En.d(Path, lambda c: c.wilmaprefix / "codecache")
 
-    observer = En.d(Observer, lambda _: Observer())
+    observer: t.Optional["Observer"] = None
 
     def observe(self, cb):
-        observer = self.observer
+        # The observer is only created when we need to watch the Wilma file.
+        # Its threads are started in the background, so that they do not add to
+        # the startup time of the process. All the watchdog modules are loaded
+        # by now.
+        from watchdog.observers import Observer
+
+        wilmafile = self.wilmafile.resolve()
+        observer = self.observer = Observer()
         observer.schedule(
-            WilmaFileChangeEvent(cb), str(self.wilmafile.parent.resolve())
+            WilmaFileChangeEvent(wilmafile, cb),
+            str(wilmafile.parent),
+            recursive=False,
         )
-        observer.start()
+        Thread(target=observer.start, name="wilma-observer", daemon=True).start()
 
 
 wilmaenv = WilmaConfig()
@@ -0,0 +1,104 @@
+"""Delta encoding of snapshots.
+
+Probes that run many times tend to capture the same objects over and over
+again. The delta encoder keeps a bounded cache of the fingerprints of the
+objects captured by each probe and replaces the objects that have not changed
+since they were last written with a back-reference of the form::
+
+    {"ref": <object id>}
+
+The delta decoder keeps the last full copy of every object written by each
+probe of each process and uses it to resolve the back-references.
+"""
+
+import typing as t
+from collections import OrderedDict
+
+
+DELTA_CACHE_SIZE = 1024
+
+
+def fingerprint(record: dict) -> t.Tuple[t.Any, int]:
+    # The record of an object only holds the ids of the objects it refers to,
+    # so this is cheap to compute.
+    return record.get("type"), hash(repr(record))
+
+
+def is_ref(record: dict) -> bool:
+    return len(record) == 1 and "ref" in record
+
+
+class DeltaEncoder(object):
+    def __init__(self, maxsize: int = DELTA_CACHE_SIZE) -> None:
+        if maxsize < 1:
+            raise ValueError("The delta cache size must be positive")
+
+        self.maxsize = maxsize
+        self._pid: t.Optional[int] = None
+        self._cache: t.Dict[str, t.OrderedDict[int, t.Tuple[t.Any, int]]] = {}
+
+    def encode(self, snapshot: dict) -> dict:
+        probe = snapshot.get("probe")
+        if probe is None:
+            return snapshot
+
+        pid = snapshot.get("pid")
+        if pid != self._pid:
+            # The decoder resolves back-references within the process that
+            # wrote them, so the fingerprints are not valid in a forked child.
+            self._cache.clear()
+            self._pid = pid
+
+        try:
+            cache = self._cache[probe]
+        except KeyError:
+            cache = self._cache[probe] = OrderedDict()
+
+        objects = []
+        for record in snapshot["objects"]:
+            _id = record["id"]
+            f = fingerprint(record)
+            if cache.get(_id) == f:
+                cache.move_to_end(_id)
+                objects.append({"ref": _id})
+                continue
+
+            cache[_id] = f
+            cache.move_to_end(_id)
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+            objects.append(record)
+
+        return dict(snapshot, objects=objects)
+
+
+class DeltaDecoder(object):
+    def __init__(self) -> None:
+        self._cache: t.Dict[t.Tuple[t.Any, str], t.Dict[int, dict]] = {}
+
+    def decode(self, snapshot: dict) -> dict:
+        probe = snapshot.get("probe")
+        if probe is None or snapshot.get("type") != "snapshot":
+            return snapshot
+
+        key = (snapshot.get("pid"), probe)
+        try:
+            cache = self._cache[key]
+        except KeyError:
+            cache = self._cache[key] = {}
+
+        objects = []
+        for record in snapshot.get("objects", []):
+            if is_ref(record):
+                _id = record["ref"]
+                try:
+                    record = cache[_id]
+                except KeyError:
+                    # The full object was not found, e.g. because the log was
+                    # truncated.
+                    record = {"id": _id, "notCapturedReason": "unresolved"}
+            else:
+                cache[record["id"]] = record
+            objects.append(record)
+
+        return dict(snapshot, objects=objects)
@@ -1,80 +1,244 @@
+import hashlib
 import json
 import logging
 import os
+import shutil
 import site
 import sys
-from subprocess import check_output
+import tempfile
+import threading
+import typing as t
+from itertools import count
+from pathlib import Path
+from subprocess import PIPE
+from subprocess import run
+from time import time
 
 from wilma._config import wilmaenv
 
 
 LOGGER = logging.getLogger(__name__)
 
+# The folder, within the Wilma prefix, of the installed dependencies
+DEPS_FOLDER = "deps"
+
+# The age, in seconds, after which an unfinished installation is discarded
+STALE_INSTALL = 3600
+
+
+def dependencies_key(dependencies: t.Dict[str, str]) -> str:
+    """The hash of the dependencies table of the configuration."""
+    return hashlib.sha256(json.dumps(dependencies, sort_keys=True).encode()).hexdigest()
+
+
+def resolved_versions(paths: t.List[str]) -> t.Dict[str, str]:
+    """The versions of the distributions installed in the given paths."""
+    try:
+        from importlib.metadata import distributions
+    except ImportError:
+        # Python < 3.8
+        return {}
+
+    return {
+        dist.metadata["Name"]: dist.version
+        for dist in distributions(path=paths)
+        if dist.metadata["Name"]
+    }
+
 
 class Dependencies:
+    """Extra dependencies of the probes.
+
+    The dependencies are installed within the Wilma prefix, in a folder of
+    their own for every dependencies table. Every successful installation is
+    recorded in a lock file, together with the hash of the dependencies table
+    that it was for, and the versions that have been installed. Configurations
+    with the same dependencies table do not need to invoke pip at all. New
+    dependencies are installed in the background, in a temporary folder that
+    is renamed once the installation is complete, so that an interrupted
+    installation never leaves anything partial behind.
+    """
+
     __all__ = set()
     __installed__ = set()
 
     def __init__(self) -> None:
-        self._path_updated = False
-        self.metadata = (
-            json.loads(wilmaenv.metadata_path.read_text())
-            if wilmaenv.metadata_path.exists()
+        self._path: t.List[str] = []
+        self._lock = threading.Lock()
+        self._generations = count(1)
+        self._generation = 0
+
+        self.lock = (
+            json.loads(wilmaenv.deps_lock_path.read_text())
+            if wilmaenv.deps_lock_path.exists()
             else {}
         )
+        if not self.lock and wilmaenv.metadata_path.exists():
+            # Dependencies installed by earlier versions of Wilma
+            self.lock = json.loads(wilmaenv.metadata_path.read_text())
+
+        self.__installed__.update(self.lock.get("dependencies", []))
+
+    @property
+    def prefix(self) -> Path:
+        # Earlier versions of Wilma installed the dependencies in the Wilma
+        # prefix itself.
+        prefix = self.lock.get("prefix")
+        return wilmaenv.wilmaprefix / prefix if prefix else wilmaenv.wilmaprefix
+
+    @property
+    def paths(self) -> t.List[str]:
+        return site.getsitepackages([str(self.prefix)])
+
+    def _update_path(self) -> None:
+        paths = self.paths
+        if paths != self._path:
+            sys.path[:] = paths + [_ for _ in sys.path if _ not in self._path]
+            self._path = paths
+
+    def install(self, config: dict, on_installed: t.Callable[[], None]) -> bool:
+        """Install the dependencies required by the configuration.
+
+        Returns whether the dependencies are available. If they are not, they
+        are being installed in the background, and ``on_installed`` is called
+        once they are.
+        """
+        table = config.get("dependencies", {})
+        deps = {f"{p}{v.replace('latest', '')}" for p, v in table.items()}
+        key = dependencies_key(table)
+
+        self._generation = generation = next(self._generations)
+
+        if not deps:
+            return True
+
+        if key == self.lock.get("key") or deps <= self.__installed__:
+            # Nothing to install
+            self._update_path()
+            return True
+
+        print("wilma: installing dependencies in the background")
+        threading.Thread(
+            target=self._install,
+            args=(deps, key, generation, on_installed),
+            name="wilma-dependencies",
+            # Do not hold up the exit of the process. An interrupted
+            # installation is discarded.
+            daemon=True,
+        ).start()
+
+        return False
+
+    def _install(
+        self,
+        deps: t.Set[str],
+        key: str,
+        generation: int,
+        on_installed: t.Callable[[], None],
+    ) -> None:
+        # Installations are serialised, so that the lock file is always
+        # consistent with the installed dependencies.
+        with self._lock:
+            prefix = DEPS_FOLDER + "/" + key[:16]
+            target = wilmaenv.wilmaprefix / prefix
+            if not target.exists() and not self._pip_install(sorted(deps), target):
+                return
+
+            self.__installed__.clear()
+            self.__installed__.update(deps)
 
-        self.__installed__.update(self.metadata.get("dependencies", []))
-
-    def install(self, config):
-        deps = {
-            f"{p}{v.replace('latest', '')}"
-            for p, v in config.get("dependencies", {}).items()
-        }
-
-        new_deps = list(deps - self.__installed__)
-
-        if new_deps:
-            LOGGER.info("Installing new dependencies: %s", new_deps)
-            pyexe = (
-                "python"
-                if wilmaenv.venv is not None
-                else "python{}.{}".format(*sys.version_info[:2])
-            )
-
-            args = [
-                pyexe,
-                "-m",
-                "pip",
-                "install",
-                "--prefix",
-                wilmaenv.wilmaprefix,
-                "--no-input",
-                "--no-python-version-warning",
-            ]
-            args += new_deps
-            env = dict(os.environ)
-
-            # Remove our custom sitecustomize from the env to avoid running pip
-            # forever.
-            if os.path.pathsep in env.get("PYTHONPATH", ""):
-                _, _, pythonpath = env.get("PYTHONPATH", "").partition(os.path.pathsep)
-                env["PYTHONPATH"] = pythonpath
-            else:
-                env["PYTHONPATH"] = ""
-            # TODO: Check for errors
-            check_output(args, env=env)
+            self.lock = {"key": key, "prefix": prefix, "dependencies": sorted(deps)}
+            self.lock["resolved"] = resolved_versions(self.paths)
+            try:
+                wilmaenv.deps_lock_path.write_text(json.dumps(self.lock, indent=2))
+            except OSError as e:
+                print(f"wilma: cannot write the dependencies lock file: {e}")
 
-            self.__installed__.update(deps)
+            self._update_path()
+
+            # TODO: Remove the dependencies that are no longer needed by any
+            # process sharing the Wilma prefix.
 
-            self.metadata["dependencies"] = list(self.__installed__)
+            # A newer configuration takes care of itself.
+            current = generation == self._generation
 
-        # TODO: Uninstall dependencies that are no longer needed
+        if current:
+            on_installed()
 
-        if not self._path_updated and deps:
-            sys.path.insert(0, *site.getsitepackages([wilmaenv.wilmaprefix]))
-            self._path_updated = True
+    def _pip_install(self, deps: t.List[str], target: Path) -> bool:
+        LOGGER.info("Installing new dependencies: %s", deps)
+        pyexe = (
+            "python"
+            if wilmaenv.venv is not None
+            else "python{}.{}".format(*sys.version_info[:2])
+        )
 
-        wilmaenv.metadata_path.write_text(json.dumps(self.metadata))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        _prune(target.parent)
+        tmp = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=str(target.parent)))
+
+        args = [
+            pyexe,
+            "-m",
+            "pip",
+            "install",
+            "--prefix",
+            str(tmp),
+            "--no-input",
+            "--no-python-version-warning",
+        ]
+        args += deps
+        env = dict(os.environ)
+
+        # Remove our custom sitecustomize from the env to avoid running pip
+        # forever.
+        if os.path.pathsep in env.get("PYTHONPATH", ""):
+            _, _, pythonpath = env.get("PYTHONPATH", "").partition(os.path.pathsep)
+            env["PYTHONPATH"] = pythonpath
+        else:
+            env["PYTHONPATH"] = ""
+
+        try:
+            try:
+                result = run(args, env=env, stdout=PIPE, stderr=PIPE)
+            except OSError as e:
+                print(
+                    f"wilma: cannot install dependencies {', '.join(deps)}: {e}. "
+                    "The probes will not be updated."
+                )
+                return False
+
+            if result.returncode != 0:
+                error = result.stderr.decode(errors="replace").strip().splitlines()
+                print(
+                    "wilma: failed to install dependencies %s: %s. "
+                    "The probes will not be updated."
+                    % (", ".join(deps), error[-1] if error else result.returncode)
+                )
+                return False
+
+            try:
+                tmp.rename(target)
+            except OSError:
+                # Another process has installed the same dependencies first.
+                if not target.exists():
+                    raise
+
+            return True
+
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _prune(folder: Path) -> None:
+    # Remove the leftovers of the installations that have been interrupted,
+    # e.g. because the process exited. Recent ones might still be running.
+    for tmp in folder.glob(".*-*"):
+        try:
+            if time() - tmp.stat().st_mtime > STALE_INSTALL:
+                shutil.rmtree(tmp, ignore_errors=True)
+        except OSError:
+            pass
 
 
 dependencies = Dependencies()
@@ -0,0 +1,29 @@
+import typing as t
+from contextlib import contextmanager
+
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None  # type: ignore[assignment]
+
+
+@contextmanager
+def file_lock(fd: int) -> t.Iterator[None]:
+    """Hold an exclusive advisory lock on an open file.
+
+    The lock is held by the process, so it excludes any other process that
+    locks the same file, including forked children that inherited the file
+    descriptor, but not the other threads of the same process. Where advisory
+    locks are not available, this is a no-op.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
@@ -1,18 +1,56 @@
+import logging
 import sys
+import threading
 import typing as t
+from abc import ABC
+from abc import abstractmethod
+from collections import defaultdict
 from contextlib import contextmanager
+from importlib.util import find_spec
+from inspect import CO_ASYNC_GENERATOR
+from inspect import CO_COROUTINE
+from inspect import CO_GENERATOR
 from pathlib import Path
+from time import perf_counter
+from time import perf_counter_ns
+from time import thread_time_ns
+from types import CodeType
 from types import FrameType
+from types import FunctionType
 from types import ModuleType
 
+from bytecode import __version__ as bytecode_version
+from ddtrace import __version__ as ddtrace_version
 from ddtrace.debugging._debugger import DebuggerModuleWatchdog
 from ddtrace.debugging._function.discovery import FunctionDiscovery
-from ddtrace.internal.injection import eject_hook
-from ddtrace.internal.injection import inject_hook
+from ddtrace.internal.injection import HookInfoType
+from ddtrace.internal.injection import eject_hooks
+from ddtrace.internal.injection import inject_hooks
 from ddtrace.internal.module import origin
+from ddtrace.internal.wrapping import WrappedFunction
+from ddtrace.internal.wrapping import unwrap
+from ddtrace.internal.wrapping import wrap
 
 import wilma
+from wilma._budget import THROTTLE
+from wilma._budget import OverheadBudget
+from wilma._budget import ProbeOverhead
+from wilma._codecache import CodeCache
+from wilma._config import wilmaenv
 from wilma._deps import dependencies
+from wilma._limits import HitLimiter
+from wilma._patterns import PatternIndex
+from wilma._patterns import PatternProbe
+from wilma._patterns import is_pattern
+
+
+LOGGER = logging.getLogger(__name__)
+
+PROBE_SETTINGS = ("when", "rate", "sample", "max_hits")
+HOOK_POINTS = ("entry", "return", "exception")
+
+# The module globals that are copied into the probe globals
+MODULE_DUNDERS = ("__name__", "__package__", "__spec__", "__file__")
 
 
 @contextmanager
@@ -26,11 +64,190 @@ def cwd():
 
 class WilmaModuleWatchdog(DebuggerModuleWatchdog):
     # DEV: This subclass is meant to avoid clashes with the superclass.
-    pass
+
+    def after_import(self, module: ModuleType) -> None:
+        super().after_import(module)
+
+        if _pattern_index:
+            on_pattern_import(module)
+
+
+class ProbeBuiltins(dict):
+    """Probe builtins.
+
+    This mapping is installed as the builtins of the probe globals so that any
+    names that are not found among the frame locals or the names injected by
+    Wilma are looked up in the module globals first, and then in the actual
+    builtins. This way the module globals never need to be copied.
+    """
+
+    def __init__(self, module_globals: t.Dict[str, t.Any], builtins: dict) -> None:
+        # DEV: The import machinery looks up __import__ directly in the
+        # underlying dictionary storage, so we need a copy of the builtins.
+        super().__init__(builtins)
+        self.module_globals = module_globals
+
+    def __getitem__(self, name: str) -> t.Any:
+        try:
+            return self.module_globals[name]
+        except KeyError:
+            return super().__getitem__(name)
+
+
+class ProbeRegistry:
+    """Probe registry.
+
+    Probes are indexed by their resolved filename and line number, so that all
+    the probes that apply to a source file can be retrieved with a single
+    lookup.
+    """
+
+    def __init__(self) -> None:
+        self._index: t.Dict[str, t.Dict[int, t.List["Probe"]]] = {}
+
+    def add(self, probe: "Probe") -> None:
+        lines = self._index.setdefault(probe.filename, {})
+        lines.setdefault(probe.lineno, []).append(probe)
+
+    def discard(self, probe: "Probe") -> None:
+        lines = self._index.get(probe.filename)
+        if lines is None or probe not in lines.get(probe.lineno, []):
+            return
+
+        lines[probe.lineno].remove(probe)
+        if not lines[probe.lineno]:
+            del lines[probe.lineno]
+            if not lines:
+                del self._index[probe.filename]
+
+    def clear(self) -> None:
+        self._index.clear()
+
+    def by_origin(self, filename: str) -> t.Dict[int, t.List["Probe"]]:
+        """Get the probes for the given source file, indexed by line number."""
+        return self._index.get(filename, {})
+
+    def __contains__(self, probe: "Probe") -> bool:
+        return probe in self.by_origin(probe.filename).get(probe.lineno, [])
+
+    def __iter__(self) -> t.Iterator["Probe"]:
+        for lines in self._index.values():
+            for probes in lines.values():
+                yield from probes
+
+    def __len__(self) -> int:
+        return sum(len(_) for lines in self._index.values() for _ in lines.values())
+
+
+class BaseProbe(ABC):
+    """Base class of probes.
+
+    It holds what all probes have in common: the imports, the condition, the
+    hit limits and the namespace that the probe code runs in.
+    """
+
+    __budget__: t.Optional[OverheadBudget] = None
+
+    def __init__(
+        self,
+        imports: t.Optional[t.List[str]] = None,
+        when: t.Optional[str] = None,
+        rate: t.Optional[float] = None,
+        sample: t.Optional[int] = None,
+        max_hits: t.Optional[int] = None,
+    ) -> None:
+        self.imports = imports or []
+        self.when = when
+        self.rate = float(rate) if rate is not None else None
+        self.sample = int(sample) if sample is not None else None
+        self.max_hits = int(max_hits) if max_hits is not None else None
+
+        # The overhead accounting of the probe, if there is a budget.
+        self.overhead: t.Optional[ProbeOverhead] = None
+
+        # Probes without limits fire on every hit, with no extra checks.
+        self.limiter: t.Optional[HitLimiter] = (
+            HitLimiter(self.rate, self.sample, self.max_hits)
+            if (self.rate, self.sample, self.max_hits) != (None, None, None)
+            else None
+        )
+
+        # Compile the probe once. Any syntax errors are reported to the caller
+        # at load time, rather than on every hit.
+        self._imports = compile(
+            "\n".join(f"import {imp}" for imp in self.imports),
+            f"<wilma imports for {self.location}>",
+            "exec",
+        )
+        self._when = self._compile(when, "condition", "eval") if when else None
+
+        # The probe globals, bound to the globals of the module the probe is
+        # in. They hold only the names injected by Wilma, and the identity of
+        # the module, and are resolved lazily on the first hit.
+        self._globals: t.Optional[t.Tuple[dict, t.Dict[str, t.Any]]] = None
+
+    @property
+    @abstractmethod
+    def location(self) -> str:
+        """The location of the probe, as given in the configuration."""
+
+    @property
+    def key(self) -> t.Tuple[t.Any, ...]:
+        return (tuple(self.imports), self.when, self.rate, self.sample, self.max_hits)
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __eq__(self, other: object) -> bool:
+        return type(other) is type(self) and self.key == t.cast(BaseProbe, other).key
+
+    def _compile(self, source: str, kind: str, mode: str = "exec") -> CodeType:
+        return compile(source, f"<wilma {kind} {self.location}>", mode)
+
+    def _probe_globals(self, frame: FrameType) -> t.Dict[str, t.Any]:
+        # Names are resolved from the frame locals first, then from the names
+        # injected by Wilma, then from the module globals and finally from the
+        # builtins. The module globals are the same on every hit, so we build
+        # the probe globals only once, with no per-hit allocations.
+        module_globals = frame.f_globals
+        if self._globals is None or self._globals[0] is not module_globals:
+            probe_globals = {
+                "wilma": wilma,
+                "__builtins__": ProbeBuiltins(module_globals, frame.f_builtins),
+            }
+            # The identity of the module, e.g. for relative imports.
+            for name in MODULE_DUNDERS:
+                if name in module_globals:
+                    probe_globals[name] = module_globals[name]
+            exec(self._imports, probe_globals)
+            self._globals = (module_globals, probe_globals)
+
+        return self._globals[1]
+
+    def check(
+        self, frame: FrameType, f_locals: t.Optional[t.Dict[str, t.Any]] = None
+    ) -> bool:
+        """Evaluate the condition of the probe, if any."""
+        if self._when is None:
+            return True
+
+        # The condition shares the probe globals, so this costs no more than
+        # the evaluation of the expression itself.
+        return bool(
+            eval(
+                self._when,
+                self._probe_globals(frame),
+                frame.f_locals if f_locals is None else f_locals,
+            )
+        )
+
+    @abstractmethod
+    def eject(self) -> None:
+        """Eject the probe from the code it has been injected into."""
 
 
-class Probe:
-    __all__: t.Set["Probe"] = set()
+class Probe(BaseProbe):
+    __all__ = ProbeRegistry()
     __injected__: t.Set["Probe"] = set()
 
     def __init__(
@@ -39,98 +256,892 @@ class Probe:
         lineno: int,
         statement: str,
         imports: t.Optional[t.List[str]] = None,
+        **settings: t.Any,
     ) -> None:
         self.filename = str(Path(filename).resolve())
         self.lineno = lineno
         self.statement = statement
-        self.imports = imports or []
 
-        self._statement = "\n".join(
-            ("\n".join(f"import {imp}" for imp in self.imports), statement)
-        )
+        super().__init__(imports, **settings)
 
-        self.__all__.add(self)
+        self._code = self._compile(statement, "probe")
 
-    def __hash__(self) -> int:
-        return hash((self.filename, self.lineno, self._statement))
+    @property
+    def location(self) -> str:
+        return f"{self.filename}:{self.lineno}"
+
+    @property
+    def key(self) -> t.Tuple[t.Any, ...]:
+        return (self.filename, self.lineno, self.statement) + super().key
 
     def __repr__(self) -> str:
         return f"WilmaProbe({self.filename}:{self.lineno} -> {self.statement})"
 
     def __call__(self, frame: FrameType) -> None:
-        return exec(
-            self._statement, dict(wilma=wilma, **frame.f_globals), frame.f_locals
+        return exec(self._code, self._probe_globals(frame), frame.f_locals)
+
+    def eject(self) -> None:
+        module = _module_by_origin(self.filename)
+        if module is not None and self in Probe.__injected__:
+            eject_probes(module, [self])
+
+
+class FunctionProbe(BaseProbe):
+    """Function probe.
+
+    Function probes are addressed by module and qualified name, and run their
+    statements on entry to the function, on return from it and when it raises
+    an exception. The return and exception statements can refer to the
+    ``duration`` of the call, in seconds, and to the ``retval`` or the
+    ``exception`` respectively. For generators and coroutines, the call lasts
+    until the generator is exhausted or the coroutine has been awaited, and
+    the return value is the one of the generator or of the coroutine.
+    """
+
+    __all__: t.Set["FunctionProbe"] = set()
+    __injected__: t.Dict["FunctionProbe", FunctionType] = {}
+
+    def __init__(
+        self,
+        module: str,
+        qualname: str,
+        entry: t.Optional[str] = None,
+        exit: t.Optional[str] = None,
+        exception: t.Optional[str] = None,
+        imports: t.Optional[t.List[str]] = None,
+        **settings: t.Any,
+    ) -> None:
+        if (entry, exit, exception) == (None, None, None):
+            raise ValueError("expected at least one of %s" % ", ".join(HOOK_POINTS))
+
+        self.module = module
+        self.qualname = qualname
+        self.statements = (entry, exit, exception)
+
+        super().__init__(imports, **settings)
+
+        self._entry = self._compile(entry, "entry probe") if entry else None
+        self._return = self._compile(exit, "return probe") if exit else None
+        self._exception = (
+            self._compile(exception, "exception probe") if exception else None
+        )
+
+        # Where the function is. These are known once the probe is injected.
+        self.filename: t.Optional[str] = None
+        self.lineno: t.Optional[int] = None
+        self._flags = 0
+
+        # DEV: Unwrapping looks for this very object among the constants of
+        # the wrapped function, so we keep hold of a single bound method.
+        self.wrapper = self._wrapper
+
+    @property
+    def location(self) -> str:
+        return f"{self.module}:{self.qualname}"
+
+    @property
+    def key(self) -> t.Tuple[t.Any, ...]:
+        return (self.module, self.qualname) + self.statements + super().key
+
+    def __repr__(self) -> str:
+        return "WilmaFunctionProbe(%s -> %s)" % (
+            self.location,
+            ", ".join(
+                f"{hook}: {statement}"
+                for hook, statement in zip(HOOK_POINTS, self.statements)
+                if statement is not None
+            ),
+        )
+
+    def _admit(self) -> bool:
+        limiter = self.limiter
+        overhead = self.overhead
+        return (limiter is None or limiter()) and (
+            overhead is None or not overhead.skip()
+        )
+
+    def _run(
+        self,
+        code: CodeType,
+        frame: FrameType,
+        f_locals: t.Dict[str, t.Any],
+        admitted: t.Optional[bool],
+    ) -> t.Optional[bool]:
+        """Run a hook of the probe.
+
+        Like with line probes, the condition is evaluated first, and only the
+        calls for which it holds are counted against the limits. A call is
+        counted at the first hook whose condition holds. Returns whether the
+        call has been admitted by the limits, or ``None`` if it has not been
+        counted yet.
+        """
+        # DEV: The frames from the probe code up are the probe code, this
+        # method, the wrapper and the wrapped function, just like with line
+        # probes, so the tools find the frames they need where they expect.
+        if self._when is not None:
+            try:
+                if not self.check(frame, f_locals):
+                    return admitted
+            except Exception as e:
+                print(f"Error while evaluating the condition of {self}: {e}")
+                return admitted
+
+        if admitted is None and not self._admit():
+            return False
+
+        overhead = self.overhead
+        if overhead is not None:
+            start, cpu_start = perf_counter_ns(), thread_time_ns()
+
+        try:
+            exec(code, self._probe_globals(frame), f_locals)
+        except Exception as e:
+            print(f"Error while executing {self}: {e}")
+
+        if overhead is not None:
+            action = overhead.record(
+                perf_counter_ns() - start, thread_time_ns() - cpu_start
+            )
+            if action is not None:
+                _over_budget(self, action)
+
+        return True
+
+    def _wrapper(
+        self, f: FunctionType, args: t.Tuple[t.Any, ...], kwargs: t.Dict[str, t.Any]
+    ) -> t.Any:
+        # The frame of the wrapped function, with the arguments as locals.
+        frame = sys._getframe(1)
+
+        # Without a condition, the limits are checked straight away, and
+        # skipped calls must be as cheap as possible.
+        admitted: t.Optional[bool] = None
+        if self._when is None:
+            limiter = self.limiter
+            overhead = self.overhead
+            if (limiter is not None and not limiter()) or (
+                overhead is not None and overhead.skip()
+            ):
+                return f(*args, **kwargs)
+            admitted = True
+
+        if self._entry is not None:
+            admitted = self._run(self._entry, frame, frame.f_locals, admitted)
+            if admitted is False:
+                return f(*args, **kwargs)
+
+        start = perf_counter()
+
+        # DEV: The wrapped generator functions delegate to the generator that
+        # we return, and the wrapped coroutine functions await the coroutine
+        # that we return, so the hooks run when the actual call completes.
+        # These run the hooks themselves, in place of the wrapper, so that the
+        # probes find the frames they need at the same depth in all cases.
+        if self._flags & CO_GENERATOR:
+            return self._generator(f(*args, **kwargs), frame, start, admitted)
+        if self._flags & CO_COROUTINE:
+            return self._coroutine(f(*args, **kwargs), frame, start, admitted)
+
+        try:
+            retval = f(*args, **kwargs)
+        except Exception as e:
+            if self._exception is not None:
+                self._run(
+                    self._exception, frame, self._locals(frame, start, e), admitted
+                )
+            raise
+
+        if self._return is not None:
+            self._run(
+                self._return,
+                frame,
+                self._locals(frame, start, None, retval),
+                admitted,
+            )
+
+        return retval
+
+    def _generator(
+        self,
+        generator: t.Generator,
+        frame: FrameType,
+        start: float,
+        admitted: t.Optional[bool],
+    ) -> t.Generator:
+        try:
+            retval = yield from generator
+        except Exception as e:
+            if self._exception is not None:
+                self._run(
+                    self._exception, frame, self._locals(frame, start, e), admitted
+                )
+            raise
+
+        if self._return is not None:
+            self._run(
+                self._return,
+                frame,
+                self._locals(frame, start, None, retval),
+                admitted,
+            )
+
+        return retval
+
+    async def _coroutine(
+        self,
+        coroutine: t.Awaitable,
+        frame: FrameType,
+        start: float,
+        admitted: t.Optional[bool],
+    ) -> t.Any:
+        try:
+            retval = await coroutine
+        except Exception as e:
+            if self._exception is not None:
+                self._run(
+                    self._exception, frame, self._locals(frame, start, e), admitted
+                )
+            raise
+
+        if self._return is not None:
+            self._run(
+                self._return,
+                frame,
+                self._locals(frame, start, None, retval),
+                admitted,
+            )
+
+        return retval
+
+    @staticmethod
+    def _locals(
+        frame: FrameType,
+        start: float,
+        exception: t.Optional[Exception],
+        retval: t.Any = None,
+    ) -> t.Dict[str, t.Any]:
+        duration = perf_counter() - start
+        if exception is not None:
+            return dict(frame.f_locals, exception=exception, duration=duration)
+        return dict(frame.f_locals, retval=retval, duration=duration)
+
+    def inject(self, module: ModuleType) -> None:
+        f = t.cast(
+            FunctionType, FunctionDiscovery.from_module(module).by_name(self.qualname)
         )
 
+        code = f.__code__
+        if code.co_flags & CO_ASYNC_GENERATOR:
+            raise TypeError("async generator functions are not supported")
+
+        self.filename, self.lineno = code.co_filename, code.co_firstlineno
+        self._flags = code.co_flags
+
+        wrap(f, self.wrapper)
+        FunctionProbe.__injected__[self] = f
+
+    def eject(self) -> None:
+        f = FunctionProbe.__injected__.pop(self, None)
+        if f is not None:
+            unwrap(t.cast(WrappedFunction, f), self.wrapper)
+
+
+def _settings(
+    spec: t.Dict[str, t.Any], reserved: t.Iterable[str]
+) -> t.Dict[str, t.Any]:
+    settings = {k: v for k, v in spec.items() if k not in reserved}
+    unknown = set(settings) - set(PROBE_SETTINGS)
+    if unknown:
+        raise ValueError("unknown settings %s" % ", ".join(sorted(unknown)))
+    return settings
+
+
+def probe_spec(spec: t.Any) -> t.Tuple[str, t.Dict[str, t.Any]]:
+    """Get the statement and the settings of a probe from its configuration.
+
+    A probe is configured either with just its statement, or with a table that
+    holds the statement together with the probe settings.
+    """
+    if isinstance(spec, str):
+        return spec, {}
+
+    if not isinstance(spec, dict) or not isinstance(spec.get("statement"), str):
+        raise ValueError("expected a statement or a table with a statement")
+
+    return spec["statement"], _settings(spec, ("statement",))
+
+
+def function_probe_spec(
+    spec: t.Any,
+) -> t.Tuple[t.Dict[str, str], t.Dict[str, t.Any]]:
+    """Get the statements and the settings of a function probe.
+
+    A function probe is configured either with just the statement to run on
+    entry, or with a table that holds the statement for each hook point,
+    together with the probe settings.
+    """
+    if isinstance(spec, str):
+        return {"entry": spec}, {}
+
+    if not isinstance(spec, dict):
+        raise ValueError("expected a statement or a table of statements")
+
+    hooks = {}
+    for hook in HOOK_POINTS:
+        if hook in spec:
+            if not isinstance(spec[hook], str):
+                raise ValueError("expected a statement for the %s hook" % hook)
+            # DEV: return is a keyword, so the argument is called exit.
+            hooks["exit" if hook == "return" else hook] = spec[hook]
+
+    return hooks, _settings(spec, HOOK_POINTS)
+
 
 def _wilma(probe: Probe) -> None:
     # If we get here, we are guaranteed a frame and its parent.
+    frame = sys._getframe(1)
+
+    # Skipped hits must be as cheap as possible.
+    if probe._when is not None:
+        try:
+            if not probe.check(frame):
+                return
+        except Exception as e:
+            print(f"Error while evaluating the condition of {probe}: {e}")
+            return
+
+    limiter = probe.limiter
+    if limiter is not None and not limiter():
+        return
+
+    overhead = probe.overhead
+    if overhead is not None:
+        if overhead.skip():
+            return
+        start, cpu_start = perf_counter_ns(), thread_time_ns()
+
     try:
-        probe(sys._getframe(1))
+        probe(frame)
     except Exception as e:
         print(f"Error while executing {probe}: {e}")
 
+    if overhead is not None:
+        action = overhead.record(
+            perf_counter_ns() - start, thread_time_ns() - cpu_start
+        )
+        if action is not None:
+            _over_budget(probe, action)
+
+
+def _over_budget(probe: BaseProbe, action: str) -> None:
+    overhead = t.cast(ProbeOverhead, probe.overhead)
+    us_per_s, cpu_percent = overhead.last_usage
+    usage = "%.0f us/s, %.1f%% CPU" % (us_per_s, cpu_percent)
+
+    if action == THROTTLE:
+        print(
+            "wilma: probe %s is over its overhead budget (%s). Firing on 1 hit in %d."
+            % (probe, usage, overhead.sample)
+        )
+        return
+
+    print(
+        "wilma: probe %s is over its overhead budget (%s). Ejecting probe."
+        % (probe, usage)
+    )
+    probe.eject()
+
+
+def _hooks_by_function(
+    module: ModuleType, probes: t.Iterable[Probe]
+) -> t.Dict[FunctionType, t.List[HookInfoType]]:
+    # Group the probe hooks by the function they need to be injected into, so
+    # that each function is rewritten only once. The function discovery is
+    # cached on the module object, so this runs only once per module.
+    discovery = FunctionDiscovery.from_module(module)
+
+    hooks: t.Dict[FunctionType, t.List[HookInfoType]] = defaultdict(list)
+    for probe in probes:
+        for f in discovery.at_line(probe.lineno):
+            # The code of wrapped functions, e.g. by function probes, is held by
+            # the innermost wrapped function.
+            while getattr(f, "__dd_wrapped__", None) is not None:
+                f = f.__dd_wrapped__
+            hooks[t.cast(FunctionType, f)].append((_wilma, probe.lineno, probe))
+
+    return hooks
+
+
+# Instrumented code objects, cached across runs. The instrumented code depends
+# on the versions of the libraries that rewrite the bytecode.
+code_cache = CodeCache(
+    wilmaenv.code_cache_path, salt=f"{ddtrace_version}-{bytecode_version}"
+)
+
+
+def _inject_hooks(f: FunctionType, hooks: t.List[HookInfoType]) -> t.List[HookInfoType]:
+    # Look for the instrumented code in the code cache first, so that we can
+    # skip rewriting the bytecode.
+    hooks.sort(key=lambda hook: (hook[1], repr(hook[2].key)))
+    objects = [_wilma] + [probe for _, _, probe in hooks]
+
+    key = code_cache.key(f.__code__, objects[1:])
+    if key is not None:
+        cached = code_cache.get(key, objects)
+        if cached is not None:
+            f.__code__, used = cached
+            return [hook for j, hook in enumerate(hooks, 1) if j not in used]
+
+    failed = inject_hooks(f, hooks)
+    if key is not None and not failed:
+        code_cache.put(key, f.__code__, objects)
+
+    return failed
+
+
+def inject_probes(module: ModuleType, probes: t.Iterable[Probe]) -> int:
+    """Inject the given probes into the functions of the given module.
+
+    Returns the number of functions that have been rewritten.
+    """
+    start = perf_counter()
+
+    hooks_by_function = _hooks_by_function(module, probes)
+    for f, hooks in hooks_by_function.items():
+        try:
+            failed = _inject_hooks(f, hooks)
+        except Exception:
+            LOGGER.debug("Failed to inject hooks into %r", f, exc_info=True)
+            failed = hooks
+
+        for _, _, probe in hooks:
+            if (_wilma, probe.lineno, probe) in failed:
+                print("wilma: failed to inject probe %s" % probe)
+            else:
+                Probe.__injected__.add(probe)
+
+    LOGGER.info(
+        "Injected probes into %d functions of module %s in %.3f ms",
+        len(hooks_by_function),
+        module.__name__,
+        (perf_counter() - start) * 1e3,
+    )
+
+    return len(hooks_by_function)
+
+
+def eject_probes(module: ModuleType, probes: t.Collection[Probe]) -> int:
+    """Eject the given probes from the functions of the given module.
+
+    Returns the number of functions that have been rewritten.
+    """
+    start = perf_counter()
+
+    # Probes that are not in any function have nothing to eject.
+    Probe.__injected__.difference_update(probes)
+
+    hooks_by_function = _hooks_by_function(module, probes)
+    for f, hooks in hooks_by_function.items():
+        try:
+            failed = eject_hooks(f, hooks)
+        except Exception:
+            LOGGER.debug("Failed to eject hooks from %r", f, exc_info=True)
+            failed = hooks
+
+        for _, _, probe in hooks:
+            if (_wilma, probe.lineno, probe) in failed:
+                print("wilma: failed to eject probe %s" % probe)
+
+    LOGGER.info(
+        "Ejected probes from %d functions of module %s in %.3f ms",
+        len(hooks_by_function),
+        module.__name__,
+        (perf_counter() - start) * 1e3,
+    )
+
+    return len(hooks_by_function)
+
+
+def _module_by_origin(filename: str) -> t.Optional[ModuleType]:
+    module = WilmaModuleWatchdog.get_by_origin(filename)
+    if module is None:
+        main = sys.modules.get("__main__")
+        if main is not None and origin(main) == filename:
+            module = main
+    return module
+
+
+def on_import(module: ModuleType) -> int:
+    probes = [
+        probe
+        for probes in Probe.__all__.by_origin(origin(module)).values()
+        for probe in probes
+        if probe not in Probe.__injected__
+    ]
+    return inject_probes(module, probes) if probes else 0
+
+
+# The modules that we are watching for function probes.
+_function_modules: t.Set[str] = set()
+
+# The pattern probes, checked against every module that is imported.
+_pattern_index = PatternIndex()
+
+
+def _qualnames(module: ModuleType) -> t.Set[str]:
+    # The functions that are indexed by line number are the ones that are
+    # defined in the module.
+    prefix = module.__name__ + "."
+    return {
+        t.cast(str, f.__fullname__)[len(prefix) :]
+        for functions in FunctionDiscovery.from_module(module).values()
+        for f in functions
+        if t.cast(str, f.__fullname__).startswith(prefix)
+    }
 
-def on_import(module: ModuleType) -> None:
-    for probe in Probe.__all__:
-        if probe in Probe.__injected__:
+
+def on_pattern_import(
+    module: ModuleType, index: t.Optional[PatternIndex] = None
+) -> int:
+    """Create and inject the probes of the patterns that match the module."""
+    path = origin(module)
+    matched = (index or _pattern_index).match(module.__name__, path)
+    if not matched:
+        return 0
+
+    line_probes: t.List[t.Tuple[PatternProbe, Probe]] = []
+    function_probes: t.List[t.Tuple[PatternProbe, FunctionProbe]] = []
+    for pattern in matched:
+        try:
+            if pattern.lineno is not None:
+                if path is None:
+                    continue
+                statement, settings = probe_spec(pattern.spec)
+                probe = Probe(
+                    path, pattern.lineno, statement, pattern.imports, **settings
+                )
+                if probe not in Probe.__all__:
+                    line_probes.append((pattern, probe))
+            else:
+                hooks, settings = function_probe_spec(pattern.spec)
+                for qualname in sorted(pattern.functions(_qualnames(module))):
+                    function_probes.append(
+                        (
+                            pattern,
+                            FunctionProbe(
+                                module.__name__,
+                                qualname,
+                                imports=pattern.imports,
+                                **hooks,
+                                **settings,
+                            ),
+                        )
+                    )
+        except (SyntaxError, TypeError, ValueError) as e:
+            print(
+                "wilma: invalid probe '%s': %s. Skipping probe." % (pattern.location, e)
+            )
+
+    budget = BaseProbe.__budget__
+    touched = 0
+
+    # Inject the line probes before wrapping any functions, like we do for the
+    # probes that are given explicitly.
+    if line_probes:
+        for pattern, probe in line_probes:
+            probe.overhead = ProbeOverhead(budget) if budget is not None else None
+            Probe.__all__.add(probe)
+            pattern.probes.append(probe)
+        touched += inject_probes(module, [probe for _, probe in line_probes])
+
+    for pattern, function_probe in function_probes:
+        if function_probe in FunctionProbe.__injected__:
+            continue
+        try:
+            function_probe.inject(module)
+        except Exception:
+            LOGGER.debug(
+                "Failed to wrap function for %r", function_probe, exc_info=True
+            )
+            continue
+        function_probe.overhead = ProbeOverhead(budget) if budget is not None else None
+        pattern.probes.append(function_probe)
+        touched += 1
+
+    return touched
+
+
+def eject_pattern(pattern: PatternProbe) -> int:
+    """Eject all the probes that have been created from a pattern."""
+    touched = 0
+
+    lines: t.Dict[str, t.List[Probe]] = defaultdict(list)
+    for probe in pattern.probes:
+        if isinstance(probe, Probe):
+            Probe.__all__.discard(probe)
+            if probe in Probe.__injected__:
+                lines[probe.filename].append(probe)
+        elif probe in FunctionProbe.__injected__:
+            probe.eject()
+            touched += 1
+
+    for filename, probes in lines.items():
+        module = _module_by_origin(filename)
+        if module is not None:
+            touched += eject_probes(module, probes)
+
+    pattern.probes.clear()
+    return touched
+
+
+def on_function_module_import(module: ModuleType) -> int:
+    injected = 0
+    for probe in FunctionProbe.__all__:
+        if probe.module != module.__name__ or probe in FunctionProbe.__injected__:
             continue
 
-        if probe.filename == origin(module):
-            # TODO: [perf] bulk inject probes
-            for f in FunctionDiscovery.from_module(module).at_line(probe.lineno):
-                try:
-                    inject_hook(f, _wilma, probe.lineno, probe)
-                    Probe.__injected__.add(probe)
-                except Exception:
-                    # TODO: Log failed injection
-                    print("wilma: failed to inject probe %s" % probe)
-                    pass
+        try:
+            probe.inject(module)
+        except ValueError:
+            print("wilma: function '%s' not found. Skipping probe." % probe.location)
+        except TypeError as e:
+            print(
+                "wilma: cannot probe function '%s': %s. Skipping probe."
+                % (probe.location, e)
+            )
+        except Exception:
+            LOGGER.debug("Failed to wrap function for %r", probe, exc_info=True)
+            print("wilma: failed to inject probe %s" % probe)
+        else:
+            injected += 1
+
+    return injected
+
+
+# Configuration changes come from the file observer and from the installation
+# of new dependencies, on different threads.
+_config_lock = threading.RLock()
 
 
 def on_config_changed(config) -> None:
-    # Update dependencies
-    dependencies.install(config)
+    with _config_lock:
+        # Update dependencies. The imports of the probes might need the new
+        # dependencies, in which case the probes that use them are applied
+        # once they have been installed. Everything else is applied right away.
+        ready = dependencies.install(config, lambda: on_config_changed(config))
+        _apply_config(config if ready else _without_missing_imports(config))
+
+
+def _bound_name(imp: str) -> str:
+    # The name bound by an import, e.g. "a.b" binds "a" and "a.b as c" binds "c"
+    module, _, alias = imp.partition(" as ")
+    return alias.strip() or module.strip().partition(".")[0]
+
+
+def _referenced_names(spec: t.Any) -> t.Set[str]:
+    # The global names used by the statements of a probe, if they compile.
+    # Invalid probes are reported when the configuration is applied.
+    sources = [spec] if isinstance(spec, str) else []
+    if isinstance(spec, dict):
+        sources = [_ for _ in spec.values() if isinstance(_, str)]
+
+    names: t.Set[str] = set()
+    codes = []
+    for source in sources:
+        try:
+            codes.append(compile(source, "<wilma>", "exec"))
+        except (SyntaxError, ValueError):
+            pass
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(_ for _ in code.co_consts if isinstance(_, CodeType))
+
+    return names
+
+
+def _without_missing_imports(config: dict) -> dict:
+    """The configuration without the imports that are not available yet.
+
+    The probes that use any of the names bound by the missing imports are left
+    out too.
+    """
+    imports = config.get("imports") or []
+    missing = [
+        imp
+        for imp in imports
+        if find_spec(imp.partition(" as ")[0].strip().partition(".")[0]) is None
+    ]
+    if not missing:
+        return config
+
+    names = {_bound_name(imp) for imp in missing}
+    return dict(
+        config,
+        imports=[_ for _ in imports if _ not in missing],
+        probes={
+            probe: spec
+            for probe, spec in config.get("probes", {}).items()
+            if not names & _referenced_names(spec)
+        },
+    )
+
+
+def _apply_config(config) -> None:
+    global _pattern_index
+
+    start = perf_counter()
 
     imports = config.get("imports")
 
-    # Update probes
-    Probe.__all__.clear()
-    probes = config.get("probes", {})
-    if probes:
-        with cwd():
-            for probe, statement in probes.items():
-                loc, _, line = probe.rpartition(":")
-                lineno = int(line)
-
-                Probe(loc, lineno, statement, imports)
-
-                try:
-                    if "__main__" in sys.modules and origin(
-                        sys.modules["__main__"]
-                    ) == str(Path(loc).resolve()):
-                        on_import(sys.modules["__main__"])
+    # Build the new probes. Probes that are unchanged compare equal to the
+    # current ones, so we can compute a precise diff.
+    probes: t.Set[Probe] = set()
+    function_probes: t.Set[FunctionProbe] = set()
+    patterns: t.Set[PatternProbe] = set()
+    locations: t.Dict[str, str] = {}
+    with cwd():
+        for probe, spec in config.get("probes", {}).items():
+            loc, _, line = probe.rpartition(":")
+
+            try:
+                if is_pattern(probe):
+                    # Parse the template once, to report any errors early.
+                    pattern = PatternProbe(probe, spec, imports)
+                    if pattern.lineno is not None:
+                        statement, settings = probe_spec(spec)
+                        Probe(probe, pattern.lineno, statement, imports, **settings)
                     else:
-                        WilmaModuleWatchdog.register_origin_hook(loc, on_import)
-                except ValueError:
-                    print("wilma: source file '%s' not found. Skipping probe." % loc)
+                        hooks, settings = function_probe_spec(spec)
+                        FunctionProbe(probe, "*", imports=imports, **hooks, **settings)
+                    patterns.add(pattern)
+                    continue
+
+                if not line.isdigit():
+                    # A function probe, addressed by module and qualified name
+                    if not loc or not line:
+                        raise ValueError("expected file.py:line or module:function")
+                    hooks, settings = function_probe_spec(spec)
+                    function_probes.add(
+                        FunctionProbe(loc, line, imports=imports, **hooks, **settings)
+                    )
+                    continue
+
+                statement, settings = probe_spec(spec)
+                new_probe = Probe(loc, int(line), statement, imports, **settings)
+            except (SyntaxError, TypeError, ValueError) as e:
+                print("wilma: invalid probe '%s': %s. Skipping probe." % (probe, e))
+                continue
+
+            probes.add(new_probe)
+            locations[new_probe.filename] = loc
+
+    current_patterns = set(_pattern_index)
+    added_patterns = patterns - current_patterns
+    removed_patterns = current_patterns - patterns
+
+    touched = 0
+
+    # The probes created from patterns come and go with them.
+    for removed_pattern in removed_patterns:
+        touched += eject_pattern(removed_pattern)
+    derived = {_ for pattern in current_patterns for _ in pattern.probes}
+
+    current = set(Probe.__all__) - derived
+    added = probes - current
+    removed = current - probes
+
+    current_functions = set(FunctionProbe.__all__)
+    added_functions = function_probes - current_functions
+    removed_functions = current_functions - function_probes
 
-    for injected_probe in Probe.__injected__ - Probe.__all__:
-        # These probes need to be removed
-        module = WilmaModuleWatchdog.get_by_origin(injected_probe.filename)
+    for removed_function_probe in removed_functions:
+        FunctionProbe.__all__.discard(removed_function_probe)
+        if removed_function_probe in FunctionProbe.__injected__:
+            removed_function_probe.eject()
+            touched += 1
+
+    # Eject the probes that are no longer configured.
+    ejected: t.Dict[str, t.List[Probe]] = defaultdict(list)
+    for removed_probe in removed:
+        Probe.__all__.discard(removed_probe)
+        if removed_probe in Probe.__injected__:
+            ejected[removed_probe.filename].append(removed_probe)
+
+    for filename, ejected_probes in ejected.items():
+        module = _module_by_origin(filename)
         if module is None:
-            if (
-                "__main__" in sys.modules
-                and origin(sys.modules["__main__"]) == injected_probe.filename
-            ):
-                module = sys.modules["__main__"]
-            if module is None:
-                print("wilma: failed to find module for probe %s" % injected_probe)
+            for ejected_probe in ejected_probes:
+                print("wilma: failed to find module for probe %s" % ejected_probe)
+            continue
+
+        touched += eject_probes(module, ejected_probes)
+
+    # Hold every probe to the overhead budget, if any. The accounting starts
+    # afresh when the budget changes.
+    budget = None
+    if "overhead" in config:
+        try:
+            budget = OverheadBudget.from_config(config["overhead"])
+        except (AttributeError, TypeError, ValueError) as e:
+            print("wilma: invalid overhead settings: %s. Ignoring." % e)
+
+    budgeted: t.Set[BaseProbe] = set(added) | added_functions
+    if budget != BaseProbe.__budget__:
+        budgeted.update(Probe.__all__)
+        budgeted.update(FunctionProbe.__all__)
+        budgeted.update(derived)
+    BaseProbe.__budget__ = budget
+    for budgeted_probe in budgeted:
+        budgeted_probe.overhead = ProbeOverhead(budget) if budget is not None else None
+
+    # Inject the new probes in bulk, one source file at a time.
+    for added_probe in added:
+        Probe.__all__.add(added_probe)
+
+    with cwd():
+        for filename in {_.filename for _ in added}:
+            module = _module_by_origin(filename)
+            if module is not None:
+                touched += on_import(module)
                 continue
-        for f in FunctionDiscovery.from_module(module).at_line(injected_probe.lineno):
+
+            loc = locations[filename]
             try:
-                eject_hook(f, _wilma, injected_probe.lineno, injected_probe)
-                Probe.__injected__.remove(probe)
-            except Exception:
-                # TODO: Log failed ejection
-                pass
+                WilmaModuleWatchdog.register_origin_hook(loc, on_import)
+            except ValueError:
+                print("wilma: source file '%s' not found. Skipping probe." % loc)
+
+    # Wrap the functions of the new function probes, as soon as their modules
+    # are imported.
+    FunctionProbe.__all__.update(added_functions)
+    for module_name in {_.module for _ in added_functions}:
+        if module_name not in _function_modules:
+            _function_modules.add(module_name)
+            # This calls the hook straight away if the module is imported.
+            WilmaModuleWatchdog.register_module_hook(
+                module_name, on_function_module_import
+            )
+        elif module_name in sys.modules:
+            touched += on_function_module_import(sys.modules[module_name])
+
+    # Index the pattern probes, and apply the new ones to the modules that are
+    # already loaded.
+    _pattern_index = PatternIndex(
+        [_ for _ in current_patterns if _ not in removed_patterns]
+        + list(added_patterns)
+    )
+    if added_patterns:
+        index = PatternIndex(added_patterns)
+        for module in list(sys.modules.values()):
+            if isinstance(module, ModuleType):
+                touched += on_pattern_import(module, index)
+
+    LOGGER.info(
+        "Configuration reloaded in %.3f ms: %d probes added, %d removed, "
+        "%d functions rewritten",
+        (perf_counter() - start) * 1e3,
+        len(added) + len(added_functions) + len(added_patterns),
+        len(removed) + len(removed_functions) + len(removed_patterns),
+        touched,
+    )
@@ -0,0 +1,88 @@
+import threading
+import typing as t
+from itertools import count
+from time import monotonic
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    The bucket holds up to ``burst`` tokens and is refilled at ``rate`` tokens
+    per second. When the bucket is empty, we record the time at which the next
+    token becomes available, so that calls made before then can be rejected
+    without taking the lock.
+    """
+
+    def __init__(self, rate: float, burst: t.Optional[float] = None) -> None:
+        if rate <= 0:
+            raise ValueError("The rate must be positive")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._empty_until = 0.0
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        now = monotonic()
+        if now < self._empty_until:
+            return False
+
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if tokens < 1.0:
+                self._tokens = tokens
+                self._empty_until = now + (1.0 - tokens) / self.rate
+                return False
+
+            self._tokens = tokens - 1.0
+            return True
+
+
+class HitLimiter(object):
+    """Decide whether a probe should fire on a hit.
+
+    A probe can fire on one hit every ``sample``, at most ``rate`` times per
+    second and at most ``max_hits`` times in total. The counters are
+    ``itertools.count`` objects, which are advanced atomically, so no locks are
+    needed for them.
+    """
+
+    def __init__(
+        self,
+        rate: t.Optional[float] = None,
+        sample: t.Optional[int] = None,
+        max_hits: t.Optional[int] = None,
+    ) -> None:
+        if sample is not None and sample < 1:
+            raise ValueError("The sample must be a positive integer")
+        if max_hits is not None and max_hits < 0:
+            raise ValueError("The maximum number of hits cannot be negative")
+
+        self.sample = sample
+        self.max_hits = max_hits
+        self.bucket = TokenBucket(rate) if rate is not None else None
+
+        self._hits = count()
+        self._fired = count()
+        self._exhausted = max_hits == 0
+
+    def __call__(self) -> bool:
+        if self._exhausted:
+            return False
+
+        if self.sample is not None and next(self._hits) % self.sample:
+            return False
+
+        if self.bucket is not None and not self.bucket.take():
+            return False
+
+        if self.max_hits is not None and next(self._fired) >= self.max_hits:
+            self._exhausted = True
+            return False
+
+        return True
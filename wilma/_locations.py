@@ -0,0 +1,65 @@
+"""Modules that might have probes.
+
+Loading the machinery that injects the probes is expensive, so it is deferred
+until a module that might have probes is imported. The modules are matched by
+name against the locations of the probes in the configuration, which rules out
+most of them without even finding their source files. The matches are a
+superset of the modules that actually have probes, e.g. a line probe in
+``app/views.py`` matches any module called ``views``. This is fine, as all a
+false match does is to load the machinery earlier than needed.
+"""
+
+import os
+import re
+import typing as t
+
+from wilma._patterns import PatternIndex
+from wilma._patterns import PatternProbe
+from wilma._patterns import is_pattern
+
+
+class ProbeLocations(object):
+    def __init__(self, config: dict) -> None:
+        # The modules of the function probes, by their full names
+        self.modules: t.Set[str] = set()
+        # The modules of the line probes, by the last part of their names
+        self.names: t.Set[str] = set()
+
+        patterns = []
+        for location in config.get("probes", {}):
+            where, _, what = location.rpartition(":")
+            try:
+                if is_pattern(location):
+                    patterns.append(PatternProbe(location, None))
+                    continue
+            except (re.error, ValueError):
+                # Invalid probes are reported once they are loaded.
+                continue
+
+            if not what.isdigit():
+                self.modules.add(where)
+                continue
+
+            head, name = os.path.split(os.path.normpath(where))
+            stem, _ = os.path.splitext(name)
+            # A line probe in a package is in the module named after its folder.
+            self.names.add(os.path.basename(head) if stem == "__init__" else stem)
+
+        self.patterns = PatternIndex(patterns)
+        self.by_path = any(_.by_path for _ in patterns)
+
+    def matches(self, name: str, path: t.Callable[[], t.Optional[str]]) -> bool:
+        """Whether the module with the given name might have probes.
+
+        The path of the module is only looked up if there are file patterns.
+        """
+        if name in self.modules or name.rpartition(".")[2] in self.names:
+            return True
+
+        if self.patterns.match(name, None):
+            return True
+
+        return self.by_path and bool(self.patterns.match(name, path()))
+
+    def __bool__(self) -> bool:
+        return bool(self.modules or self.names or self.patterns)
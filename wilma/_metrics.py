@@ -0,0 +1,294 @@
+"""In-process aggregation of metrics.
+
+Counters and histograms are updated in thread-local shards, so that threads do
+not contend with each other. A background thread periodically merges the
+shards and appends a summary of every metric to the metrics file, as JSON
+lines.
+"""
+
+import atexit
+import json
+import os
+import threading
+import typing as t
+from math import ceil
+from math import log
+from time import perf_counter
+from time import time
+
+from wilma._config import wilmaenv
+
+
+# The relative accuracy of the histogram percentiles is about 1%.
+GAMMA = 1.02
+LOG_GAMMA = log(GAMMA)
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram(object):
+    """Mergeable histogram with logarithmic buckets.
+
+    Non-positive values are all counted in the lowest bucket.
+    """
+
+    __slots__ = ("count", "sum", "min", "max", "zeros", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.zeros = 0
+        self.buckets: t.Dict[int, int] = {}
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if value > 0:
+            i = ceil(log(value) / LOG_GAMMA)
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+        else:
+            self.zeros += 1
+
+    def merge(self, other: "Histogram") -> None:
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return self.min
+
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                # The bucket holds the values in (GAMMA ** (i - 1), GAMMA ** i]
+                value = 2 * GAMMA**i / (GAMMA + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def summary(self) -> t.Dict[str, t.Any]:
+        summary = {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+        for q in PERCENTILES:
+            summary["p%g" % (q * 100)] = self.percentile(q)
+        return summary
+
+
+class Shard(object):
+    """The metrics of a single thread.
+
+    The lock is only ever contended by the flusher.
+    """
+
+    def __init__(self) -> None:
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+        self.counters: t.Dict[str, int] = {}
+        self.histograms: t.Dict[str, Histogram] = {}
+        self.timers: t.Dict[str, t.List[float]] = {}
+
+
+class Metrics(object):
+    def __init__(self, path, interval: float = 10.0) -> None:
+        if interval <= 0:
+            raise ValueError("The flush interval must be positive")
+
+        self.path = path
+        self.interval = interval
+
+        self._local = threading.local()
+        self._shards: t.List[Shard] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: t.Optional[threading.Thread] = None
+
+        if hasattr(os, "register_at_fork"):
+            # The flusher thread does not survive a fork, and the metrics of
+            # the parent process have been flushed by the parent already.
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_config(cls, path, config: dict) -> "Metrics":
+        return cls(path, interval=float(config.get("interval", 10.0)))
+
+    def _after_fork(self) -> None:
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def shard(self) -> Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+
+        shard = self._local.shard = Shard()
+        with self._lock:
+            self._shards.append(shard)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="wilma-metrics", daemon=True
+                )
+                self._thread.start()
+        return shard
+
+    def count(self, name: str, n: int = 1) -> None:
+        shard = self.shard()
+        with shard.lock:
+            shard.counters[name] = shard.counters.get(name, 0) + n
+
+    def histogram(self, name: str, value: float) -> None:
+        shard = self.shard()
+        with shard.lock:
+            try:
+                histogram = shard.histograms[name]
+            except KeyError:
+                histogram = shard.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def start(self, name: str) -> None:
+        # Timers are thread-local, so they do not need the lock.
+        self.shard().timers.setdefault(name, []).append(perf_counter())
+
+    def stop(self, name: str) -> None:
+        end = perf_counter()
+        try:
+            start = self.shard().timers[name].pop()
+        except (KeyError, IndexError):
+            # Stopping a timer that was never started
+            return
+        self.histogram(name, end - start)
+
+    def collect(self) -> t.Tuple[t.Dict[str, int], t.Dict[str, Histogram]]:
+        """Merge and reset the metrics of all the shards."""
+        counters: t.Dict[str, int] = {}
+        histograms: t.Dict[str, Histogram] = {}
+
+        with self._lock:
+            shards = list(self._shards)
+
+        for shard in shards:
+            with shard.lock:
+                shard_counters, shard.counters = shard.counters, {}
+                shard_histograms, shard.histograms = shard.histograms, {}
+
+            for name, n in shard_counters.items():
+                counters[name] = counters.get(name, 0) + n
+            for name, h in shard_histograms.items():
+                try:
+                    histograms[name].merge(h)
+                except KeyError:
+                    histograms[name] = h
+
+        # Forget about the shards of the threads that are gone, now that we
+        # have their metrics.
+        dead = [_ for _ in shards if not _.thread.is_alive()]
+        if dead:
+            with self._lock:
+                self._shards = [_ for _ in self._shards if _ not in dead]
+
+        return counters, histograms
+
+    def flush(self) -> None:
+        counters, histograms = self.collect()
+        if not (counters or histograms):
+            return
+
+        timestamp = time()
+        pid = os.getpid()
+        records = [
+            dict(type="counter", name=name, timestamp=timestamp, pid=pid, count=n)
+            for name, n in sorted(counters.items())
+        ] + [
+            dict(
+                type="histogram",
+                name=name,
+                timestamp=timestamp,
+                pid=pid,
+                **histogram.summary(),
+            )
+            for name, histogram in sorted(histograms.items())
+        ]
+
+        with self.path.open("a") as f:
+            f.write("".join(json.dumps(_) + "\n" for _ in records))
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"wilma: failed to flush metrics: {e}")
+
+    def close(self) -> None:
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=1.0)
+        self.flush()
+
+
+_metrics: t.Optional[Metrics] = None
+
+
+def _get_metrics() -> Metrics:
+    global _metrics
+
+    if _metrics is None:
+        settings = wilmaenv.wilmaconfig.get("metrics", {})
+        try:
+            metrics = Metrics.from_config(wilmaenv.metrics_path, settings)
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"wilma: invalid metrics settings: {e}. Using defaults.")
+            metrics = Metrics(wilmaenv.metrics_path)
+        atexit.register(metrics.close)
+        _metrics = metrics
+
+    return _metrics
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increment the counter with the given name."""
+    _get_metrics().count(name, n)
+
+
+def histogram(name: str, value: float) -> None:
+    """Add a value to the histogram with the given name."""
+    _get_metrics().histogram(name, value)
+
+
+def start(name: str) -> None:
+    """Start the timer with the given name.
+
+    The duration, in seconds, is added to the histogram with the same name
+    when the timer is stopped by the same thread.
+    """
+    _get_metrics().start(name)
+
+
+def stop(name: str) -> None:
+    """Stop the timer with the given name."""
+    _get_metrics().stop(name)
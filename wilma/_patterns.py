@@ -0,0 +1,214 @@
+"""Pattern probe locations.
+
+A pattern location is made of a file or module pattern, followed by either a
+line number or a function pattern, e.g.
+
+    myapp/handlers/*.py:**       every function in the matching files
+    myapp.handlers.*:handle_*    the matching functions in the matching modules
+    myapp/models.py:/^Model\\./   the functions matching a regular expression
+    myapp/*/views.py:42          line 42 of the matching files
+    myapp/**/views.py:42         the same, in any subfolder of myapp
+
+File and module patterns are globs. File patterns are told apart from module
+patterns by the presence of a path separator or of the ``.py`` extension, and
+are relative to the working directory. Function patterns are either globs that
+match the whole qualified name of the functions, or regular expressions within
+slashes.
+
+Within globs, ``*`` and ``?`` do not match the path separator in file patterns,
+nor the dot in module and function patterns, so that a pattern for a package
+does not match its subpackages, and a pattern for the functions of a module
+does not match the methods of its classes. A ``**`` matches across separators
+instead.
+"""
+
+import os
+import re
+import typing as t
+
+
+GLOB_CHARS = frozenset("*?[")
+
+
+def translate(pattern: str, sep: str) -> str:
+    """Translate a glob pattern into a regular expression.
+
+    Unlike with :func:`fnmatch.translate`, ``*`` and ``?`` do not match the
+    given separator, while ``**`` matches any number of components, including
+    none, when it is followed by the separator.
+    """
+    s = re.escape(sep)
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern.startswith("*", i):
+                i += 1
+                if pattern.startswith(sep, i):
+                    i += len(sep)
+                    parts.append(f"(?:.*{s})?")
+                else:
+                    parts.append(".*")
+            else:
+                parts.append(f"[^{s}]*")
+        elif c == "?":
+            parts.append(f"[^{s}]")
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                parts.append(re.escape(c))
+                continue
+            chars = pattern[i:j].replace("\\", "\\\\")
+            i = j + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            parts.append(f"[{chars}]")
+        else:
+            parts.append(re.escape(c))
+
+    return "(?s:%s)\\Z" % "".join(parts)
+
+
+def split_location(location: str) -> t.Tuple[str, str]:
+    # Regular expressions might contain colons.
+    if location.endswith("/"):
+        i = location.rfind(":/")
+        if i > 0:
+            return location[:i], location[i + 1 :]
+
+    where, _, what = location.rpartition(":")
+    return where, what
+
+
+def is_regex(what: str) -> bool:
+    return len(what) > 1 and what[0] == what[-1] == "/"
+
+
+def is_pattern(location: str) -> bool:
+    where, what = split_location(location)
+    return bool(GLOB_CHARS & set(where) or GLOB_CHARS & set(what) or is_regex(what))
+
+
+class PatternProbe(object):
+    """A probe template that applies to all the matching locations.
+
+    The concrete probes that are created from the template, for every matching
+    module, are kept in ``probes``.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        spec: t.Any,
+        imports: t.Optional[t.List[str]] = None,
+    ) -> None:
+        where, what = split_location(location)
+        if not where or not what:
+            raise ValueError("expected a file or module pattern and a target")
+
+        self.location = location
+        self.spec = spec
+        self.imports = imports or []
+
+        self.by_path = os.sep in where or "/" in where or where.endswith(".py")
+        if self.by_path and not os.path.isabs(where):
+            where = os.path.join(os.getcwd(), where)
+        self.where = (
+            translate(os.path.normpath(where), os.sep)
+            if self.by_path
+            else translate(where, ".")
+        )
+        self._where = re.compile(self.where)
+
+        self.lineno: t.Optional[int] = int(what) if what.isdigit() else None
+        self._functions: t.Optional[t.Callable[[str], t.Any]] = None
+        if self.lineno is None:
+            self._functions = (
+                re.compile(what[1:-1]).search
+                if is_regex(what)
+                else re.compile(translate(what, ".")).match
+            )
+
+        self.probes: t.List[t.Any] = []
+
+    @property
+    def key(self) -> t.Tuple[t.Any, ...]:
+        spec = self.spec
+        if isinstance(spec, dict):
+            spec = tuple(sorted(spec.items()))
+        return (self.location, spec, tuple(self.imports))
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, PatternProbe) and self.key == other.key
+
+    def __repr__(self) -> str:
+        return f"WilmaPatternProbe({self.location})"
+
+    def matches(self, name: str, path: t.Optional[str]) -> bool:
+        subject = path if self.by_path else name
+        return subject is not None and self._where.match(subject) is not None
+
+    def functions(self, qualnames: t.Iterable[str]) -> t.List[str]:
+        """Select the matching functions among the given qualified names."""
+        if self._functions is None:
+            return []
+        return [_ for _ in qualnames if self._functions(_)]
+
+
+class PatternIndex(object):
+    """Index of pattern probes.
+
+    The file and module patterns are compiled into a single regular expression
+    each, so that the modules that match none of them, which are the vast
+    majority, are ruled out with a single match. Only the modules that match
+    are checked against the individual patterns.
+    """
+
+    def __init__(self, patterns: t.Iterable[PatternProbe] = ()) -> None:
+        self.patterns = list(patterns)
+
+        self._paths = self._combine(_ for _ in self.patterns if _.by_path)
+        self._modules = self._combine(_ for _ in self.patterns if not _.by_path)
+
+    @staticmethod
+    def _combine(patterns: t.Iterable[PatternProbe]) -> t.Optional[t.Pattern]:
+        sources = {_.where for _ in patterns}
+        return (
+            re.compile("|".join(f"(?:{_})" for _ in sorted(sources)))
+            if sources
+            else None
+        )
+
+    def match(self, name: str, path: t.Optional[str]) -> t.List[PatternProbe]:
+        """Get the pattern probes that match the given module."""
+        matched = []
+
+        if path is not None and self._paths is not None and self._paths.match(path):
+            matched.extend(
+                _ for _ in self.patterns if _.by_path and _.matches(name, path)
+            )
+
+        if self._modules is not None and self._modules.match(name):
+            matched.extend(
+                _ for _ in self.patterns if not _.by_path and _.matches(name, path)
+            )
+
+        return matched
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def __iter__(self) -> t.Iterator[PatternProbe]:
+        return iter(self.patterns)
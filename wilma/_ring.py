@@ -0,0 +1,140 @@
+"""Memory-mapped ring buffer of capture records.
+
+The ring file has a fixed size and is made of a header, followed by the data
+area. Records are appended to the data area and wrap around to its start when
+they would not fit at its end, overwriting the oldest records. Each record is
+self-contained and carries a sequence number and a checksum, so that the most
+recent records can be recovered even if the process that wrote them died while
+writing, simply by scanning the data area for valid records.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import typing as t
+import zlib
+from pathlib import Path
+
+from wilma._filelock import file_lock
+
+
+RING_MAGIC = b"WILMARNG"
+RING_VERSION = 1
+RECORD_MAGIC = b"WREC"
+
+# magic, version, capacity, next offset, next sequence number
+_header = struct.Struct("<8sIQQQ")
+_state = struct.Struct("<QQ")
+_STATE_OFFSET = 20
+HEADER_SIZE = 64
+
+# magic, sequence number, length, crc32
+_record = struct.Struct("<4sQII")
+
+
+class RingBuffer(object):
+    def __init__(self, path: Path, capacity: int) -> None:
+        if capacity <= _record.size:
+            raise ValueError("The ring buffer capacity is too small")
+
+        self.path = path
+        self.capacity = capacity
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+
+        size = HEADER_SIZE + capacity
+        # DEV: The file stays open, as it is locked to reserve space for the
+        # records.
+        self._fd = fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with file_lock(fd):
+                header = os.read(fd, _header.size)
+                valid = False
+                if len(header) == _header.size:
+                    magic, version, cap, _, _ = _header.unpack(header)
+                    valid = cap == capacity and (magic, version) == (
+                        RING_MAGIC,
+                        RING_VERSION,
+                    )
+
+                if not valid or os.fstat(fd).st_size != size:
+                    # Start a new ring. Any existing data is discarded.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+
+                self._map = mmap.mmap(fd, size)
+
+                if not valid:
+                    self._map[: _header.size] = _header.pack(
+                        RING_MAGIC, RING_VERSION, capacity, 0, 0
+                    )
+        except Exception:
+            os.close(fd)
+            raise
+
+    def write(self, payload: bytes) -> None:
+        n = _record.size + len(payload)
+        if n > self.capacity:
+            self.dropped += 1
+            return
+
+        buffer = self._map
+        # The ring state lives in the mapped header, so that it is shared with
+        # any other process that maps the same file, e.g. forked workers. The
+        # space for the record is reserved under the thread lock, for the
+        # threads of this process, and under the file lock, for the other
+        # processes. The record itself is written without holding either.
+        with self._lock, file_lock(self._fd):
+            offset, seq = _state.unpack_from(buffer, _STATE_OFFSET)
+            if offset + n > self.capacity:
+                offset = 0
+            _state.pack_into(buffer, _STATE_OFFSET, offset + n, seq + 1)
+
+        start = HEADER_SIZE + offset
+        _record.pack_into(
+            buffer, start, RECORD_MAGIC, seq, len(payload), zlib.crc32(payload)
+        )
+        buffer[start + _record.size : start + n] = payload
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        if not self._map.closed:
+            self._map.flush()
+            self._map.close()
+            os.close(self._fd)
+
+
+def is_ring(data: bytes) -> bool:
+    return data[: len(RING_MAGIC)] == RING_MAGIC
+
+
+def records(data: bytes) -> t.Iterator[bytes]:
+    """Recover the valid records from the content of a ring file.
+
+    The records are returned from the oldest to the most recent.
+    """
+    magic, version, capacity, _, _ = _header.unpack_from(data)
+    if magic != RING_MAGIC or version != RING_VERSION:
+        raise ValueError("Not a Wilma ring file")
+
+    area = bytes(data[HEADER_SIZE : HEADER_SIZE + capacity])
+
+    found = []
+    pos = area.find(RECORD_MAGIC)
+    while 0 <= pos <= len(area) - _record.size:
+        _, seq, length, crc = _record.unpack_from(area, pos)
+        start = pos + _record.size
+        payload = area[start : start + length]
+        if len(payload) == length and zlib.crc32(payload) == crc:
+            found.append((seq, payload))
+            pos = area.find(RECORD_MAGIC, start + length)
+        else:
+            # Partially overwritten or torn record
+            pos = area.find(RECORD_MAGIC, pos + 1)
+
+    for _, payload in sorted(found, key=lambda _: _[0]):
+        yield payload
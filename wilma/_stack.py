@@ -0,0 +1,117 @@
+"""Call stacks of captures.
+
+Snapshots hold the raw call stack, that is a tuple of (code object, line
+number) pairs, which is cheap to collect. The capture writers turn it into a
+list of frames. When stacks are interned, every distinct stack is written only
+once, as a record of the form::
+
+    {"type": "stack", "id": <stack id>, "pid": <pid>, "frames": [...]}
+
+and the snapshots refer to it with their ``stackId`` field.
+"""
+
+import typing as t
+from types import CodeType
+from types import FrameType
+
+
+MAXSTACKS = 4096
+
+Stack = t.Tuple[t.Tuple[CodeType, int], ...]
+
+
+def walk_stack(frame: t.Optional[FrameType], maxsize: int) -> Stack:
+    stack = []
+    while frame is not None and len(stack) < maxsize:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(stack)
+
+
+def format_stack(stack: Stack) -> t.List[t.Dict[str, t.Any]]:
+    return [
+        {
+            "fileName": code.co_filename,
+            "function": code.co_name,
+            "lineNumber": lineno,
+        }
+        for code, lineno in stack
+    ]
+
+
+class StackTable(object):
+    """Table of interned call stacks.
+
+    The table is meant to be used by a single writer thread.
+    """
+
+    def __init__(self, maxsize: int = MAXSTACKS) -> None:
+        self.maxsize = maxsize
+
+        self._pid: t.Optional[int] = None
+        # DEV: Code objects are hashed by value, which is expensive, so we key
+        # the table by their ids instead. The table holds on to the stacks, and
+        # therefore to their code objects, so the ids cannot be reused.
+        self._ids: t.Dict[t.Tuple[t.Tuple[int, int], ...], t.Tuple[int, Stack]] = {}
+
+    def intern(self, stack: Stack, pid: int) -> t.Tuple[t.Optional[int], bool]:
+        """Intern a stack.
+
+        Return the id of the stack, or ``None`` if the table is full, and
+        whether the stack was not in the table already.
+        """
+        if pid != self._pid:
+            # Stack ids are only valid within the process that assigned them,
+            # e.g. they are not valid in a forked child.
+            self._ids.clear()
+            self._pid = pid
+
+        key = tuple((id(code), lineno) for code, lineno in stack)
+        try:
+            return self._ids[key][0], False
+        except KeyError:
+            pass
+
+        if len(self._ids) >= self.maxsize:
+            return None, False
+
+        stack_id = len(self._ids)
+        self._ids[key] = (stack_id, stack)
+        return stack_id, True
+
+
+def expand_stacks(
+    captures: t.Iterable[dict], table: t.Optional[StackTable] = None
+) -> t.Iterator[dict]:
+    """Turn the raw stacks of the given snapshots into lists of frames.
+
+    If a stack table is given, the stacks are interned and the records of the
+    new stacks are generated right before the first snapshot that refers to
+    them.
+    """
+    for capture in captures:
+        stack = capture.get("stack")
+        if type(stack) is not tuple:
+            yield capture
+            continue
+
+        capture = dict(capture)
+
+        if table is not None:
+            pid = capture.get("pid")
+            stack_id, new = table.intern(stack, pid)
+            if stack_id is not None:
+                if new:
+                    yield {
+                        "type": "stack",
+                        "id": stack_id,
+                        "pid": pid,
+                        "frames": format_stack(stack),
+                    }
+                del capture["stack"]
+                capture["stackId"] = stack_id
+                yield capture
+                continue
+
+        capture["stack"] = format_stack(stack)
+        yield capture
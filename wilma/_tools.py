@@ -56,3 +56,15 @@ try:
     from wilma._capture import watch
 except ImportError:
     watch = ToolNotAvailable("watch")
+
+
+try:
+    from wilma._metrics import count
+    from wilma._metrics import histogram
+    from wilma._metrics import start
+    from wilma._metrics import stop
+except ImportError:
+    count = ToolNotAvailable("count")
+    histogram = ToolNotAvailable("histogram")
+    start = ToolNotAvailable("start")
+    stop = ToolNotAvailable("stop")
@@ -1,19 +1,406 @@
 import json
+import logging
+import os
+import sys
+import threading
 import typing as t
+from abc import ABC
+from abc import abstractmethod
+from collections import deque
 from pathlib import Path
+from time import monotonic
 
+from wilma._codec import BinaryEncoder
+from wilma._delta import DeltaEncoder
+from wilma._filelock import file_lock
+from wilma._ring import RingBuffer
+from wilma._stack import StackTable
+from wilma._stack import expand_stacks
 
-class JsonFileWriter(object):
-    def __init__(self, path: Path):
+
+LOGGER = logging.getLogger(__name__)
+
+
+def materialize(capture: t.Any) -> dict:
+    # Deferred captures are expanded by the writer.
+    return capture if isinstance(capture, dict) else capture.to_json()
+
+
+class FileWriter(ABC):
+    mode = "a"
+
+    def __init__(
+        self,
+        path: Path,
+        delta: t.Optional[DeltaEncoder] = None,
+        stacks: t.Optional[StackTable] = None,
+    ):
         self.path = path
-        self.stream: t.Optional[t.TextIO] = None
+        self.delta = delta
+        self.stacks = stacks
+        self.stream: t.Optional[t.IO] = None
+
+    def open(self) -> t.IO:
+        return self.path.open(self.mode)
+
+    @abstractmethod
+    def encode(self, captures: t.Iterable[dict]) -> t.Any:
+        """Encode a batch of captures for the stream."""
 
-    def write(self, capture):
+    def write(self, captures: t.Iterable[dict]) -> None:
         if self.stream is None:
-            self.stream = self.path.open("a")
+            self.stream = self.open()
 
-        print(json.dumps(capture), file=self.stream)
+        captures = expand_stacks(captures, self.stacks)
+        if self.delta is not None:
+            captures = (self.delta.encode(_) for _ in captures)
 
-    def __del__(self):
+        self.append(self.stream, captures)
+
+    def append(self, stream: t.IO, captures: t.Iterable[dict]) -> None:
+        stream.write(self.encode(captures))
+        stream.flush()
+
+    def after_fork(self) -> None:
+        """Reset the writer in a forked child process.
+
+        The child must not share the stream of the parent. The stream is
+        flushed after every write, so closing the copy in the child does not
+        write anything twice.
+        """
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def sync(self) -> None:
+        if self.stream is not None:
+            os.fsync(self.stream.fileno())
+
+    def close(self) -> None:
         if self.stream is not None:
             self.stream.close()
+            self.stream = None
+
+    def __call__(self, capture: dict) -> None:
+        self.write([capture])
+
+    def __del__(self):
+        self.close()
+
+
+class JsonFileWriter(FileWriter):
+    def encode(self, captures: t.Iterable[dict]) -> str:
+        return "".join(json.dumps(capture) + "\n" for capture in captures)
+
+
+class BinaryFileWriter(FileWriter):
+    mode = "ab"
+
+    def __init__(
+        self,
+        path: Path,
+        delta: t.Optional[DeltaEncoder] = None,
+        stacks: t.Optional[StackTable] = None,
+    ):
+        super().__init__(path, delta, stacks)
+        self.encoder = BinaryEncoder()
+        # The size of the file at the end of our last write
+        self._end: t.Optional[int] = None
+
+    def open(self) -> t.IO:
+        # Every process appends its own session to the file, which starts with
+        # a header that resets the string table. The header is written with
+        # the first batch.
+        self._end = None
+        return super().open()
+
+    def append(self, stream: t.IO, captures: t.Iterable[dict]) -> None:
+        with file_lock(stream.fileno()):
+            data = b""
+            if os.fstat(stream.fileno()).st_size != self._end:
+                # Another process, e.g. a forked child, has appended to the
+                # file since our last write, so the records that follow would
+                # be decoded with its string table. Start a new session.
+                data = self.encoder.header()
+            data += self.encode(captures)
+
+            stream.write(data)
+            stream.flush()
+            self._end = stream.tell()
+
+    def after_fork(self) -> None:
+        super().after_fork()
+        self.encoder = BinaryEncoder()
+        self._end = None
+
+    def encode(self, captures: t.Iterable[dict]) -> bytes:
+        return b"".join(self.encoder.encode(capture) for capture in captures)
+
+
+class RingFileWriter(object):
+    """Write captures to a memory-mapped ring file.
+
+    Each capture is encoded as a self-contained record and copied straight
+    into the mapped memory by the thread that produced it. The ring file always
+    holds the most recent captures, which survive the process even if it
+    crashes.
+    """
+
+    def __init__(self, path: Path, size: int, binary: bool = False) -> None:
+        self.ring = RingBuffer(path, size)
+        self.binary = binary
+
+    def __call__(self, capture: t.Any) -> None:
+        (capture,) = expand_stacks([materialize(capture)])
+        if self.binary:
+            # Use a new session for every record, so that each one can be
+            # decoded on its own.
+            encoder = BinaryEncoder()
+            self.ring.write(encoder.header() + encoder.encode(capture))
+        else:
+            self.ring.write(json.dumps(capture).encode("utf-8"))
+
+    def close(self) -> None:
+        self.ring.close()
+
+        if self.ring.dropped:
+            LOGGER.warning(
+                "Dropped %d captures larger than the ring file", self.ring.dropped
+            )
+
+
+WRITERS: t.Dict[str, t.Type[FileWriter]] = {
+    "json": JsonFileWriter,
+    "binary": BinaryFileWriter,
+}
+
+
+class AsyncWriter(object):
+    """Write captures from a background thread.
+
+    Captures are put on a bounded queue that is drained in batches by a
+    background thread, so that the thread that produced them does not pay for
+    the encoding and the file I/O. When the queue is full, the overflow policy
+    decides whether to drop the newest capture, the oldest one, or to block
+    until there is room for it.
+    """
+
+    DROP_NEWEST = "drop_newest"
+    DROP_OLDEST = "drop_oldest"
+    BLOCK = "block"
+
+    OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+    def __init__(
+        self,
+        writer: FileWriter,
+        queue_size: int = 1024,
+        overflow: str = DROP_NEWEST,
+        batch_size: int = 64,
+        flush_interval: float = 0.1,
+        fsync_interval: float = 1.0,
+    ) -> None:
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "Invalid overflow policy '%s'. Expected one of %s"
+                % (overflow, ", ".join(self.OVERFLOW_POLICIES))
+            )
+        if queue_size < 1:
+            raise ValueError("The capture queue size must be positive")
+
+        self.writer = writer
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        self.dropped = 0
+        self.written = 0
+
+        # DEV: Appending to and popping from a deque are atomic operations, so
+        # the hot path does not need to take any locks, unless the queue is
+        # full.
+        self._queue: t.Deque[t.Any] = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._thread: t.Optional[threading.Thread] = None
+        self._stopped = False
+        # Whether the writer thread is running, and whether it has to close the
+        # writer when it stops. Both are guarded by the lock.
+        self._running = False
+        self._handoff = False
+
+        if hasattr(os, "register_at_fork"):
+            # The writer thread does not survive a fork, so we start a fresh
+            # one in the child process.
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_config(cls, writer: FileWriter, config: dict) -> "AsyncWriter":
+        return cls(
+            writer,
+            queue_size=int(config.get("queue_size", 1024)),
+            overflow=config.get("overflow", cls.DROP_NEWEST),
+            batch_size=int(config.get("batch_size", 64)),
+            flush_interval=float(config.get("flush_interval", 0.1)),
+            fsync_interval=float(config.get("fsync_interval", 1.0)),
+        )
+
+    def _after_fork(self) -> None:
+        self.writer.after_fork()
+        self._queue.clear()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = self._handoff = False
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(
+                target=self._run, name="wilma-writer", daemon=True
+            )
+            self._running = True
+            self._thread.start()
+
+    def _drop(self) -> None:
+        with self._lock:
+            self.dropped += 1
+
+    def __call__(self, capture: t.Any) -> None:
+        if self._thread is None:
+            self._start()
+
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            if self.overflow == self.DROP_NEWEST:
+                self._drop()
+                return
+
+            if self.overflow == self.DROP_OLDEST:
+                try:
+                    queue.popleft()
+                    self._drop()
+                except IndexError:
+                    pass
+
+            else:
+                self._wakeup.set()
+                with self._not_full:
+                    while len(queue) >= self.queue_size and not self._stopped:
+                        self._not_full.wait(self.flush_interval)
+
+        queue.append(capture)
+
+        if len(queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _drain(self) -> int:
+        queue = self._queue
+        n = 0
+        while queue:
+            batch = []
+            try:
+                for _ in range(self.batch_size):
+                    capture = queue.popleft()
+                    try:
+                        batch.append(materialize(capture))
+                    except Exception:
+                        LOGGER.error("Failed to expand capture", exc_info=True)
+            except IndexError:
+                pass
+
+            if self.overflow == self.BLOCK:
+                with self._not_full:
+                    self._not_full.notify_all()
+
+            try:
+                self.writer.write(batch)
+            except Exception:
+                LOGGER.error("Failed to write %d captures", len(batch), exc_info=True)
+            else:
+                n += len(batch)
+
+        self.written += n
+        return n
+
+    def _run(self) -> None:
+        last_sync = monotonic()
+        dirty = False
+
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            dirty |= self._drain() > 0
+
+            if dirty and monotonic() - last_sync >= self.fsync_interval:
+                self.writer.sync()
+                last_sync = monotonic()
+                dirty = False
+
+        with self._lock:
+            self._running = False
+            handoff = self._handoff
+
+        if handoff:
+            self._finish()
+
+    def close(self, exiting: bool = False) -> None:
+        """Stop the writer thread and write any pending captures.
+
+        When the process is exiting, this waits for the writer thread to write
+        all the pending captures, however long it takes, as it would be killed
+        with the interpreter otherwise.
+        """
+        self._stopped = True
+        self._wakeup.set()
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=max(1.0, 2 * self.flush_interval))
+
+        with self._lock:
+            # The writer thread might still be busy, e.g. expanding a large
+            # batch of deferred captures. The writer is not thread-safe, so we
+            # leave it to the writer thread to write the pending captures and
+            # close it.
+            handoff = self._handoff = self._running
+
+        if not handoff:
+            self._finish()
+            return
+
+        if not (exiting or sys.is_finalizing()):
+            LOGGER.warning(
+                "The capture writer is still busy. Pending captures are "
+                "written in the background"
+            )
+            return
+
+        # The writer thread is a daemon thread, so it would be killed with the
+        # interpreter before it is done.
+        LOGGER.warning(
+            "The capture writer is still busy. Waiting for the pending captures "
+            "to be written"
+        )
+        t.cast(threading.Thread, thread).join()
+
+    def _finish(self) -> None:
+        self._drain()
+        self.writer.sync()
+        self.writer.close()
+
+        if self.dropped:
+            LOGGER.warning(
+                "Dropped %d captures because the capture queue was full "
+                "(queue size %d, overflow policy '%s')",
+                self.dropped,
+                self.queue_size,
+                self.overflow,
+            )